@@ -26,13 +26,13 @@ a listening socket under various protocols.
 
 from __future__ import absolute_import
 
-import socket
 import time
 
 import gevent
 from gevent.server import StreamServer
 
 from slimta import logging
+from slimta.util.hostname import get_hostname
 
 __all__ = ['Edge', 'EdgeServer']
 
@@ -51,14 +51,15 @@ class Edge(object):
                      received message in its
                      :attr:`~slimta.envelope.Envelope.receiver` attribute for
                      use in headers and bounce messages. By default, the return
-                     value of :func:`~socket.getfqdn()` is used.
+                     value of :func:`~slimta.util.hostname.get_hostname()` is
+                     used.
 
     """
 
     def __init__(self, queue, hostname=None):
         super(Edge, self).__init__()
         self.queue = queue
-        self.hostname = hostname or socket.getfqdn()
+        self.hostname = hostname or get_hostname()
 
     def handoff(self, envelope):
         """This method may be called manually or by whatever mechanism a
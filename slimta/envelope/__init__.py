@@ -176,12 +176,12 @@ class Envelope(object):
 
         """
         assert self.message is not None
-        try:
+        if self.message.isascii():
+            return
+        if not encoder:
+            # Raises the UnicodeDecodeError describing the 8-bit data.
             self.message.decode('ascii')
-        except UnicodeDecodeError:
-            if not encoder:
-                raise
-            self._encode_parts(encoder)
+        self._encode_parts(encoder)
 
     def parse_msg(self, msg):
         """Parses the given :class:`~email.message.Message` to
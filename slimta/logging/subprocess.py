@@ -26,6 +26,7 @@ operations.
 
 from __future__ import absolute_import
 
+import logging
 from functools import partial
 
 from .log import logline
@@ -43,18 +44,25 @@ class SubprocessLogger(object):
     """
 
     def __init__(self, log):
+        self.logger = log
         self.log = partial(logline, log.debug, 'pid')
 
     def popen(self, process, args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         self.log(process.pid, 'popen', args=args)
 
     def stdio(self, process, stdin, stdout, stderr):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         self.log(process.pid, 'stdio',
                  stdin=stdin,
                  stdout=stdout,
                  stderr=stderr)
 
     def exit(self, process):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         self.log(process.pid, 'exit', returncode=process.returncode)
 
 
@@ -26,12 +26,12 @@ standard RFC headers.
 
 from __future__ import absolute_import
 
-import socket
 import uuid
 from time import strftime, gmtime, localtime
 from math import floor
 
 from slimta.core import __version__ as VERSION
+from slimta.util.hostname import get_hostname
 from . import QueuePolicy
 
 __all__ = ['AddDateHeader', 'AddMessageIdHeader', 'AddReceivedHeader']
@@ -67,12 +67,12 @@ class AddMessageIdHeader(QueuePolicy):
     adding it if it does not exist.
 
     :param hostname: The hostname to use in the generated headers. By default,
-                     :func:`~socket.getfqdn()` is used.
+                     :func:`~slimta.util.hostname.get_hostname()` is used.
 
     """
 
     def __init__(self, hostname=None):
-        self.hostname = hostname or socket.getfqdn()
+        self.hostname = hostname or get_hostname()
 
     def apply(self, envelope):
         if 'message-id' not in envelope.headers:
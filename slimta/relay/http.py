@@ -28,8 +28,6 @@ for exchanging mail.
 
 from __future__ import absolute_import
 
-import re
-import socket
 from base64 import b64encode
 from urllib import parse as urlparse
 
@@ -38,6 +36,7 @@ import gevent
 from slimta import logging
 from slimta.smtp.reply import Reply
 from slimta.http import get_connection
+from slimta.util.hostname import get_hostname
 from . import PermanentRelayError, TransientRelayError
 from .pool import RelayPool, RelayPoolClient
 from .smtp import SmtpRelayError
@@ -49,20 +48,19 @@ log = logging.getHttpLogger(__name__)
 
 class HttpRelayClient(RelayPoolClient):
 
-    reply_code_pattern = re.compile(r'^\s*(\d\d\d)\s*;')
-    reply_param_pattern = re.compile(r'\s(\w+)\s*=\s*"(.*?)"')
-
     def __init__(self, relay):
         super(HttpRelayClient, self).__init__(relay.queue, relay.idle_timeout)
         self.conn = None
         self.ehlo_as = None
         self.url = relay.url
         self.relay = relay
+        self._sender_header = relay.sender_header.encode('iso-8859-1')
+        self._recipient_header = relay.recipient_header.encode('iso-8859-1')
+        self._static_headers = None
 
     def _wait_for_request(self):
         result, envelope = self.poll()
         if result and envelope:
-            self.idle = False
             self._handle_request(result, envelope)
         else:
             if self.conn:
@@ -70,26 +68,31 @@ class HttpRelayClient(RelayPoolClient):
                 self.conn = None
 
     def _b64encode(self, what):
-        return b64encode(what.encode('utf-8')).decode('ascii')
+        return b64encode(what.encode('utf-8'))
+
+    def _build_static_headers(self):
+        return [(b'Content-Type', b'message/rfc822'),
+                (self.relay.ehlo_header.encode('iso-8859-1'),
+                 self.ehlo_as.encode('iso-8859-1'))]
 
     def _build_headers(self, envelope, msg_headers, msg_body):
         content_length = str(len(msg_headers) + len(msg_body))
-        headers = [('Content-Length', content_length),
-                   ('Content-Type', 'message/rfc822'),
-                   (self.relay.ehlo_header, self.ehlo_as),
-                   (self.relay.sender_header,
-                    self._b64encode(envelope.sender))]
+        headers = [(b'Content-Length', content_length.encode('ascii'))]
+        headers.extend(self._static_headers)
+        headers.append((self._sender_header,
+                        self._b64encode(envelope.sender)))
         for rcpt in envelope.recipients:
-            headers.append((self.relay.recipient_header,
+            headers.append((self._recipient_header,
                             self._b64encode(rcpt)))
         return headers
 
     def _new_conn(self):
         self.conn = get_connection(self.url, self.relay.context)
-        try:
+        if callable(self.relay.ehlo_as):
             self.ehlo_as = self.relay.ehlo_as()
-        except TypeError:
+        else:
             self.ehlo_as = self.relay.ehlo_as
+        self._static_headers = self._build_static_headers()
 
     def _handle_request(self, result, envelope):
         method = self.relay.http_verb
@@ -102,25 +105,42 @@ class HttpRelayClient(RelayPoolClient):
             log.request(self.conn, method, self.url.path, headers)
             self.conn.putrequest(method, self.url.path)
             for name, value in headers:
-                self.conn.putheader(name.encode('iso-8859-1'),
-                                    value.encode('iso-8859-1'))
+                self.conn.putheader(name, value)
             self.conn.endheaders(msg_headers)
             self.conn.send(msg_body)
             self._process_response(self.conn.getresponse(), result)
 
+    def _iter_reply_params(self, params):
+        pos = 0
+        while True:
+            equals = params.find('=', pos)
+            if equals < 0:
+                return
+            start = params.find('"', equals + 1)
+            end = params.find('"', start + 1)
+            if start < 0 or end < 0:
+                return
+            names = params[pos:equals].split()
+            if names and not params[equals + 1:start].strip():
+                yield names[-1], params[start + 1:end]
+            pos = end + 1
+
     def _parse_smtp_reply_header(self, http_res):
         raw_reply = http_res.getheader('X-Smtp-Reply', '')
-        match = re.match(self.reply_code_pattern, raw_reply)
-        if not match:
+        if not raw_reply:
+            return None
+        code, sep, params = raw_reply.partition(';')
+        code = code.strip()
+        if not sep or len(code) != 3 or not code.isdigit():
             return None
-        code = match.group(1)
         message = ''
         command = None
-        for match in re.finditer(self.reply_param_pattern, raw_reply):
-            if match.group(1).lower() == 'message':
-                message = match.group(2)
-            elif match.group(1).lower() == 'command':
-                command = match.group(2)
+        for name, value in self._iter_reply_params(params):
+            name = name.lower()
+            if name == 'message':
+                message = value
+            elif name == 'command':
+                command = value
         return Reply(code, message, command)
 
     def _process_response(self, http_res, result):
@@ -207,7 +227,7 @@ class HttpRelay(RelayPool):
         super(HttpRelay, self).__init__(pool_size)
         self.url = urlparse.urlsplit(url, 'http')
         self.context = context
-        self.ehlo_as = ehlo_as or socket.getfqdn()
+        self.ehlo_as = ehlo_as or get_hostname()
         self.timeout = timeout
         self.idle_timeout = idle_timeout
 
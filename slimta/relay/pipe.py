@@ -32,19 +32,156 @@ modeled closely off the pipe_ daemon in postfix.
 
 from __future__ import absolute_import
 
+import os
 import re
+import signal
+from logging import DEBUG
+from string import Formatter
 
-from gevent import Timeout
+import gevent
+from gevent import Timeout, get_hub
 from gevent import subprocess
+from gevent.event import Event
+from gevent.fileobject import FileObject
+from gevent.socket import wait_write
 
 from slimta.smtp.reply import Reply
 from slimta.relay import Relay, PermanentRelayError, TransientRelayError
 from slimta import logging
+from .pool import RelayPool, RelayPoolClient
 
-__all__ = ['PipeRelay', 'MaildropRelay', 'DovecotLdaRelay']
+__all__ = ['PipeRelay', 'PersistentPipeRelay', 'MaildropRelay',
+           'DovecotLdaRelay']
 
 log = logging.getSubprocessLogger(__name__)
 
+_formatter = Formatter()
+_field_sep = re.compile(r'[.\[]')
+
+_posix_spawn_supported = hasattr(os, 'posix_spawnp') and \
+    os.path.isdir('/dev/fd')
+_writev_supported = hasattr(os, 'writev')
+
+_MAILDROP_PREFIX = b'maildrop: '
+
+
+def _decode_output(output):
+    if isinstance(output, bytes):
+        return output.decode('utf-8', 'replace')
+    return output
+
+
+def _writev_all(fd, buffers):
+    # Hands all the buffers to the kernel together, without concatenating
+    # them, resuming after short writes.
+    os.set_blocking(fd, False)
+    views = [memoryview(buf) for buf in buffers if buf]
+    while views:
+        try:
+            written = os.writev(fd, views)
+        except BlockingIOError:
+            wait_write(fd)
+            continue
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            del views[0]
+        if written:
+            views[0] = views[0][written:]
+
+
+def _read_bounded(fileobj, limit):
+    data = fileobj.read(limit)
+    if len(data) >= limit:
+        while fileobj.read(limit):
+            pass
+    return data
+
+
+def _is_permanent(error_msg):
+    # Equivalent to matching r'^5\.\d+\.\d+\s' against the message.
+    if error_msg[:2] != '5.':
+        return False
+    subject, dot, detail = error_msg[2:].partition('.')
+    if not dot or not subject.isdecimal():
+        return False
+    end = 0
+    while end < len(detail) and detail[end].isdecimal():
+        end += 1
+    return 0 < end < len(detail) and detail[end].isspace()
+
+
+# Signals ignored by the interpreter that subprocess restores in the child.
+_default_signals = [getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ')
+                    if hasattr(signal, name)]
+
+
+def _inherited_fds():
+    # Descriptors that Popen(close_fds=True) would close in the child.
+    fds = []
+    for name in os.listdir('/dev/fd'):
+        fd = int(name)
+        if fd > 2:
+            try:
+                if os.get_inheritable(fd):
+                    fds.append(fd)
+            except OSError:
+                pass
+    return fds
+
+
+class _SpawnedProcess(object):
+    # Stands in for Popen when the process is started with posix_spawnp(),
+    # which avoids copying the page tables of a large parent process. The
+    # child watcher is started before yielding to the hub so that the exit
+    # status cannot be missed.
+
+    def __init__(self, args):
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        file_actions = [(os.POSIX_SPAWN_DUP2, stdin_r, 0),
+                        (os.POSIX_SPAWN_DUP2, stdout_w, 1),
+                        (os.POSIX_SPAWN_DUP2, stderr_w, 2)]
+        file_actions.extend((os.POSIX_SPAWN_CLOSE, fd)
+                            for fd in _inherited_fds())
+        try:
+            self.pid = os.posix_spawnp(args[0], args, os.environ,
+                                       file_actions=file_actions,
+                                       setsigdef=_default_signals)
+        except OSError:
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+        self.returncode = None
+        self._exited = Event()
+        loop = get_hub().loop
+        loop.install_sigchld()
+        self._watcher = loop.child(self.pid, False)
+        self._watcher.start(self._on_exit)
+        self.stdin = FileObject(stdin_w, 'wb')
+        self.stdout = FileObject(stdout_r, 'rb')
+        self.stderr = FileObject(stderr_r, 'rb')
+
+    def _on_exit(self):
+        self._watcher.stop()
+        status = self._watcher.rstatus
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        self._exited.set()
+
+    def kill(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+    def wait(self):
+        self._exited.wait()
+        return self.returncode
+
 
 class PipeRelay(Relay):
     """When delivery attempts are made on this object, it will create a new
@@ -67,44 +204,148 @@ class PipeRelay(Relay):
 
     :param args: List of arguments used to spawn the external process, as you
                  would provide them to the :py:class:`~subprocess.Popen`
-                 constructor. Each argument has :py:meth:`str.format` called on
-                 it, as described above.
+                 constructor. Each argument is parsed for
+                 :py:meth:`str.format` macros when the relay is created, as
+                 described above, and unknown macros raise :py:exc:`KeyError`.
     :param timeout: The length of time a delivery is allowed to run before it
                     fails transiently, default unlimited.
     :param popen_kwargs: Extra keyword arguments passed in to the
-                         :py:class:`~subprocess.Popen`.
+                         :py:class:`~subprocess.Popen`. If none are given and
+                         :py:func:`os.posix_spawnp` is available, it is used
+                         to start the process instead, avoiding a ``fork()``
+                         of the relay process.
 
     """
 
-    _permanent_error_pattern = re.compile(r'^5\.\d+\.\d+\s')
+    _macro_getters = {
+        'sender': lambda env: env.sender,
+        'message_id': lambda env: env.headers.get('Message-Id', ''),
+        'client_ip': lambda env: env.client.get('ip', ''),
+        'client_host': lambda env: env.client.get('host', ''),
+        'client_ehlo': lambda env: env.client.get('name', ''),
+        'client_protocol': lambda env: env.client.get('protocol', ''),
+        'client_auth': lambda env: env.client.get('auth', '')}
 
     #: If ``True``, the process will be executed once per recipient.
     per_recipient = True
 
+    #: The number of bytes kept from each of the process stdout and stderr.
+    #: Anything written past this is read and discarded.
+    max_output = 65536
+
     def __init__(self, args, timeout=None, **popen_kwargs):
         super(PipeRelay, self).__init__()
         self.args = args
         self.timeout = timeout
         self.popen_kwargs = popen_kwargs
-
-    def _process_args(self, env, rcpt):
-        macros = {'sender': env.sender,
-                  'recipient': rcpt,
-                  'message_id': env.headers.get('Message-Id', ''),
-                  'client_ip': env.client.get('ip', ''),
-                  'client_host': env.client.get('host', ''),
-                  'client_ehlo': env.client.get('name', ''),
-                  'client_protocol': env.client.get('protocol', ''),
-                  'client_auth': env.client.get('auth', '')}
-        return [arg.format(**macros) for arg in self.args]
-
-    def _exec_process(self, args, stdin):
-        p = subprocess.Popen(args, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             **self.popen_kwargs)
+        self._arg_plans = [self._compile_arg(arg) for arg in args]
+        self._rcpt_args = [self._uses_recipient(plan)
+                           for plan in self._arg_plans]
+        self._env_fields = set(name for plan in self._arg_plans
+                               for name in self._plan_macros(plan)
+                               if name != 'recipient')
+        self._posix_spawn = _posix_spawn_supported and not popen_kwargs
+
+    def _compile_arg(self, arg):
+        plan = []
+        for literal, field, spec, conversion in _formatter.parse(arg):
+            plan.append((literal, field, conversion, spec))
+        for name in self._plan_macros(plan):
+            if name != 'recipient' and name not in self._macro_getters:
+                raise KeyError(name)
+        return plan
+
+    def _plan_macros(self, plan):
+        # Yields the macro names used by attribute, index and nested format
+        # spec fields, such as sender in {sender[0]} or {recipient:{sender}}.
+        for _, field, _, spec in plan:
+            if field is not None:
+                yield _field_sep.split(field, 1)[0]
+                for _, nested, _, _ in _formatter.parse(spec):
+                    if nested is not None:
+                        yield _field_sep.split(nested, 1)[0]
+
+    def _get_macros(self, env):
+        macros = {'recipient': None}
+        for field in self._env_fields:
+            macros[field] = self._macro_getters[field](env)
+        return macros
+
+    def _format_arg(self, plan, macros):
+        if len(plan) == 1:
+            literal, field, conversion, spec = plan[0]
+            if field in macros and not (literal or conversion or spec):
+                value = macros[field]
+                if isinstance(value, str):
+                    return value
+        parts = []
+        for literal, field, conversion, spec in plan:
+            parts.append(literal)
+            if field is not None:
+                if field in macros:
+                    value = macros[field]
+                else:
+                    value = _formatter.get_field(field, (), macros)[0]
+                if conversion:
+                    value = _formatter.convert_field(value, conversion)
+                if '{' in spec:
+                    spec = _formatter.vformat(spec, (), macros)
+                parts.append(format(value, spec))
+        return ''.join(parts)
+
+    def _uses_recipient(self, plan):
+        return 'recipient' in self._plan_macros(plan)
+
+    def _format_static(self, macros):
+        return [None if rcpt_arg else self._format_arg(plan, macros)
+                for plan, rcpt_arg in zip(self._arg_plans, self._rcpt_args)]
+
+    def _process_args(self, macros, static_args=None):
+        if static_args is None:
+            static_args = self._format_static(macros)
+        return [self._format_arg(plan, macros) if arg is None else arg
+                for plan, arg in zip(self._arg_plans, static_args)]
+
+    def _write_stdin(self, p, header_data, message_data):
+        try:
+            try:
+                if _writev_supported:
+                    _writev_all(p.stdin.fileno(), [header_data, message_data])
+                else:
+                    p.stdin.write(header_data)
+                    p.stdin.write(message_data)
+            finally:
+                p.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def _spawn_process(self, args):
+        if self._posix_spawn:
+            return _SpawnedProcess(args)
+        return subprocess.Popen(args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                **self.popen_kwargs)
+
+    def _exec_process(self, args, header_data, message_data):
+        p = self._spawn_process(args)
         log.popen(p, args)
-        stdout, stderr = p.communicate(stdin)
+        greenlets = [gevent.spawn(_read_bounded, p.stdout, self.max_output),
+                     gevent.spawn(_read_bounded, p.stderr, self.max_output)]
+        try:
+            self._write_stdin(p, header_data, message_data)
+            gevent.joinall(greenlets, raise_error=True)
+            p.wait()
+        except BaseException:
+            gevent.killall(greenlets)
+            raise
+        finally:
+            p.stdout.close()
+            p.stderr.close()
+        stdout, stderr = greenlets[0].value, greenlets[1].value
+        stdin = None
+        if log.logger.isEnabledFor(DEBUG):
+            stdin = header_data + message_data
         log.stdio(p, stdin, stdout, stderr)
         log.exit(p)
         if p.returncode != 0:
@@ -116,29 +357,35 @@ class PipeRelay(Relay):
 
     def _try_pipe_all_rcpts(self, envelope):
         header_data, message_data = envelope.flatten()
-        stdin = b''.join((header_data, message_data))
         results = {}
         try:
             with Timeout(self.timeout):
+                macros = self._get_macros(envelope)
+                static_args = self._format_static(macros)
+                process_args = self._process_args
+                exec_process = self._exec_process
                 for rcpt in envelope.recipients:
-                    args = self._process_args(envelope, rcpt)
-                    results[rcpt] = self._exec_process(args, stdin)
+                    macros['recipient'] = rcpt
+                    args = process_args(macros, static_args)
+                    results[rcpt] = exec_process(args, header_data,
+                                                 message_data)
         except Timeout:
+            msg = 'Delivery timed out'
+            reply = Reply('450', '4.4.2 ' + msg)
+            timeout_error = TransientRelayError(msg, reply)
             for rcpt in envelope.recipients:
-                if rcpt not in results:
-                    msg = 'Delivery timed out'
-                    reply = Reply('450', '4.4.2 ' + msg)
-                    results[rcpt] = TransientRelayError(msg, reply)
+                results.setdefault(rcpt, timeout_error)
         return results
 
     def _try_pipe_one_rcpt(self, envelope):
         header_data, message_data = envelope.flatten()
-        stdin = b''.join((header_data, message_data))
         rcpt = envelope.recipients[0]
         try:
             with Timeout(self.timeout):
-                args = self._process_args(envelope, rcpt)
-                return self._exec_process(args, stdin)
+                macros = self._get_macros(envelope)
+                macros['recipient'] = rcpt
+                args = self._process_args(macros)
+                return self._exec_process(args, header_data, message_data)
         except Timeout:
             msg = 'Delivery timed out'
             reply = Reply('450', '4.4.2 ' + msg)
@@ -155,20 +402,17 @@ class PipeRelay(Relay):
         status.
 
         :param status: The non-zero exit status of the subprocess.
-        :param stdout: The subprocess's standard output, as received by
-                       :py:meth:`~subprocess.Popen.communicate`.
-        :type stdout: string
-        :param stderr: The subprocess's standard error output, as received by
-                       :py:meth:`~subprocess.Popen.communicate`.
-        :type stderr: string
+        :param stdout: The subprocess's standard output.
+        :type stdout: :py:obj:`bytes`
+        :param stderr: The subprocess's standard error output.
+        :type stderr: :py:obj:`bytes`
         :raises: :class:`~slimta.relay.TransientRelayError`,
                  :class:`~slimta.relay.PermanentRelayError`
 
         """
-        error_msg = stdout.rstrip() or stderr.rstrip() or 'Delivery failed'
-        if isinstance(error_msg, bytes):
-            error_msg = error_msg.decode('utf-8')
-        if self._permanent_error_pattern.match(error_msg):
+        error_msg = _decode_output(stdout.rstrip() or stderr.rstrip()) or \
+            'Delivery failed'
+        if _is_permanent(error_msg):
             reply = Reply('550', error_msg)
             raise PermanentRelayError(error_msg, reply)
         else:
@@ -182,6 +426,179 @@ class PipeRelay(Relay):
             return self._try_pipe_one_rcpt(envelope)
 
 
+class PipeWorkerClient(RelayPoolClient):
+    """Delivers envelopes from a :class:`PersistentPipeRelay` queue through a
+    single long-lived worker process.
+
+    """
+
+    #: Seconds a worker is given to exit after its standard input is closed,
+    #: after which it is killed.
+    stop_timeout = 10.0
+
+    def __init__(self, relay):
+        super(PipeWorkerClient, self).__init__(relay.queue, relay.idle_timeout)
+        self.relay = relay
+        self.process = None
+
+    def _start_process(self):
+        self.process = subprocess.Popen(self.relay.args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        **self.relay.popen_kwargs)
+        log.popen(self.process, self.relay.args)
+
+    def _stop_process(self):
+        p, self.process = self.process, None
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            p.wait(self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+        log.exit(p)
+
+    def _kill_process(self):
+        p, self.process = self.process, None
+        p.kill()
+        p.wait()
+        log.exit(p)
+
+    def _send_frame(self, sender, rcpt, header_data, message_data):
+        size = len(header_data) + len(message_data)
+        frame_header = '{0} {1} {2}\n'.format(len(sender), len(rcpt), size)
+        stdin = self.process.stdin
+        stdin.write(frame_header.encode('ascii'))
+        stdin.write(sender)
+        stdin.write(rcpt)
+        stdin.write(header_data)
+        stdin.write(message_data)
+        stdin.flush()
+        return self.process.stdout.readline()
+
+    def _deliver_rcpt(self, envelope, rcpt, header_data, message_data):
+        if self.process is None:
+            self._start_process()
+        sender = (envelope.sender or '').encode('utf-8')
+        try:
+            ack = self._send_frame(sender, rcpt.encode('utf-8'),
+                                   header_data, message_data)
+        except OSError:
+            self._kill_process()
+            return TransientRelayError('Worker process failed')
+        if not ack:
+            self._stop_process()
+            return TransientRelayError('Worker process exited')
+        status, _, error_msg = ack.rstrip().partition(b' ')
+        try:
+            status = int(status)
+        except ValueError:
+            self._stop_process()
+            return TransientRelayError('Invalid worker response')
+        if status != 0:
+            try:
+                self.relay.raise_error(status, error_msg, b'')
+            except (PermanentRelayError, TransientRelayError) as exc:
+                return exc
+        return None
+
+    def _deliver(self, result, envelope):
+        header_data, message_data = envelope.flatten()
+        results = {}
+        try:
+            with Timeout(self.relay.timeout):
+                for rcpt in envelope.recipients:
+                    results[rcpt] = self._deliver_rcpt(
+                        envelope, rcpt, header_data, message_data)
+        except Timeout:
+            if self.process:
+                self._kill_process()
+            msg = 'Delivery timed out'
+            reply = Reply('450', '4.4.2 ' + msg)
+            timeout_error = TransientRelayError(msg, reply)
+            for rcpt in envelope.recipients:
+                results.setdefault(rcpt, timeout_error)
+        except Exception as exc:
+            result.set_exception(exc)
+            raise
+        result.set(results)
+
+    def _run(self):
+        try:
+            while True:
+                result, envelope = self.poll()
+                if not result or not envelope:
+                    break
+                self._deliver(result, envelope)
+        finally:
+            if self.process:
+                self._stop_process()
+
+
+class PersistentPipeRelay(PipeRelay, RelayPool):
+    """Variation of :class:`PipeRelay` that keeps a pool of long-lived worker
+    processes rather than spawning a new process for every delivery. The
+    command must support this batch mode: for each recipient it is given one
+    frame on standard input, laid out as::
+
+        <sender length> <recipient length> <message length>\n
+        <sender><recipient><message>
+
+    The first line holds three ASCII decimal byte counts separated by single
+    spaces. It is followed immediately by the UTF-8 encoded sender (empty for
+    a null sender), the UTF-8 encoded recipient and the flattened message
+    headers and body, with no separators between them. Before reading the next
+    frame, the worker must write exactly one acknowledgement line to standard
+    output::
+
+        0\n
+        <status> <error message>\n
+
+    ``0`` means success. A non-zero decimal status, optionally followed by a
+    space and an error message, is passed to :meth:`~PipeRelay.raise_error`
+    as the status and standard output. A line that does not start with a
+    decimal status, or the worker exiting, fails the recipient transiently and
+    the worker is replaced.
+
+    :param args: List of arguments used to spawn each worker process. Since
+                 workers handle many envelopes, these arguments are used as
+                 given and may not contain macros.
+    :param pool_size: At most this many worker processes will be running at
+                      once. If this limit is reached and no workers are idle,
+                      new attempts will block.
+    :param timeout: The length of time a delivery is allowed to run before it
+                    fails transiently and the worker is killed, default
+                    unlimited.
+    :param idle_timeout: Timeout in seconds that a worker is kept waiting for
+                         another delivery before it is stopped. By default,
+                         workers are kept running until the relay is killed.
+    :param popen_kwargs: Extra keyword arguments passed in to the
+                         :py:class:`~subprocess.Popen`.
+    :raises: :py:exc:`ValueError` if any of ``args`` contains a macro.
+
+    """
+
+    def __init__(self, args, pool_size=None, timeout=None, idle_timeout=None,
+                 **popen_kwargs):
+        for arg in args:
+            if any(field is not None
+                   for _, field, _, _ in _formatter.parse(arg)):
+                raise ValueError('Macros are not supported', arg)
+        super(PersistentPipeRelay, self).__init__(args, timeout,
+                                                  **popen_kwargs)
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+
+    def add_client(self):
+        return PipeWorkerClient(self)
+
+    def attempt(self, envelope, attempts):
+        return RelayPool.attempt(self, envelope, attempts)
+
+
 class MaildropRelay(PipeRelay):
     """Variation of :class:`PipeRelay` that is specifically tailored for
     calling `courier-maildrop`_ for local mail delivery.
@@ -207,10 +624,10 @@ class MaildropRelay(PipeRelay):
 
     def raise_error(self, status, stdout, stderr):
         error_msg = 'Delivery failed'
-        if stdout.startswith('maildrop: '):
-            error_msg = stdout[10:].rstrip()
-        elif stderr.startswith('maildrop: '):
-            error_msg = stderr[10:].rstrip()
+        if stdout[:10] == _MAILDROP_PREFIX:
+            error_msg = _decode_output(stdout[10:].rstrip())
+        elif stderr[:10] == _MAILDROP_PREFIX:
+            error_msg = _decode_output(stderr[10:].rstrip())
         if status == self.EX_TEMPFAIL:
             reply = Reply('450', error_msg)
             raise TransientRelayError(error_msg, reply)
@@ -245,7 +662,8 @@ class DovecotLdaRelay(PipeRelay):
         super(DovecotLdaRelay, self).__init__(args, timeout)
 
     def raise_error(self, status, stdout, stderr):
-        error_msg = stdout.rstrip() or stderr.rstrip() or 'LDA delivery failed'
+        error_msg = _decode_output(stdout.rstrip() or stderr.rstrip()) or \
+            'LDA delivery failed'
         if status == self.EX_TEMPFAIL:
             reply = Reply('450', error_msg)
             raise TransientRelayError(error_msg, reply)
@@ -28,7 +28,7 @@ from __future__ import absolute_import
 from gevent import Greenlet, Timeout
 from gevent.event import AsyncResult  # type: ignore
 
-from slimta.util.deque import BlockingDeque
+from slimta.util.ring import GeventRing
 from . import Relay
 
 __all__ = ['RelayPool', 'RelayPoolClient']
@@ -52,28 +52,27 @@ class RelayPool(Relay):
 
         #: This attribute holds the queue object for providing delivery
         #: requests to idle clients in the pool.
-        self.queue = BlockingDeque()
+        self.queue = GeventRing()
 
     def kill(self):
         for client in self.pool:
             client.kill()
 
     def _remove_client(self, client):
-        self.pool.remove(client)
+        self.pool.discard(client)
         if len(self.queue) > 0 and not self.pool:
             self._add_client()
 
     def _add_client(self):
         client = self.add_client()
         client.queue = self.queue
-        client.start()
-        client.link(self._remove_client)
         self.pool.add(client)
+        client.link(self._remove_client)
+        client.start()
 
     def _check_idle(self):
-        for client in self.pool:
-            if client.idle:
-                return
+        if self.queue.waiting:
+            return
         if not self.pool_size or len(self.pool) < self.pool_size:
             self._add_client()
 
@@ -106,7 +105,6 @@ class RelayPoolClient(Greenlet):
 
     def __init__(self, queue, idle_timeout=None):
         super(RelayPoolClient, self).__init__()
-        self.idle = False
         self.queue = queue
 
         #: This attribute holds the idle timeout for handling multiple delivery
@@ -125,13 +123,9 @@ class RelayPoolClient(Greenlet):
                   returned.
 
         """
-        self.idle = True
-        try:
-            with Timeout(self.idle_timeout, False):
-                return self.queue.popleft()
-            return None, None
-        finally:
-            self.idle = False
+        with Timeout(self.idle_timeout, False):
+            return self.queue.popleft()
+        return None, None
 
     def _run(self):
         """This method must be overridden by sub-classes to handle processing
@@ -34,13 +34,46 @@ from .. import RelayError, TransientRelayError, PermanentRelayError
 __all__ = ['SmtpRelayError']
 
 
+_command_names = {}
+
+
+def _decode_command(command):
+    try:
+        return _command_names[command]
+    except KeyError:
+        name = _command_names[command] = command.decode('ascii')
+        return name
+
+
 class SmtpRelayError(RelayError):
 
     def __init__(self, type, reply):
-        command = reply.command or b'[unknown command]'
-        msg = '{0} failure on {1}: {2}'.format(
-            type, command.decode('ascii'), str(reply))
-        super(SmtpRelayError, self).__init__(msg, reply)
+        super(SmtpRelayError, self).__init__(None, reply)
+        self._type = type
+        self._msg = None
+
+    @property
+    def msg(self):
+        """The error message, formatted from the reply the first time it is
+        needed.
+
+        """
+        if self._msg is None:
+            command = _decode_command(self.reply.command or
+                                      b'[unknown command]')
+            self._msg = '{0} failure on {1}: {2}'.format(
+                self._type, command, str(self.reply))
+        return self._msg
+
+    @property
+    def args(self):
+        return (self.msg, )
+
+    def __str__(self):
+        return self.msg
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.msg)
 
     @staticmethod
     def factory(reply):
@@ -22,15 +22,16 @@
 from __future__ import absolute_import
 
 import socket
-from functools import wraps
 
 from gevent import Timeout
 from gevent.socket import create_connection
 
 from slimta.smtp import SmtpError
-from slimta.smtp.reply import Reply, timed_out, connection_failed
+from slimta.smtp.reply import Reply, timed_out, connection_failed, \
+    conversion_not_allowed
 from slimta.smtp.client import Client
 from slimta import logging
+from slimta.util.hostname import get_hostname
 from ..pool import RelayPoolClient
 from . import SmtpRelayError
 
@@ -39,17 +40,20 @@ __all__ = ['SmtpRelayClient']
 log = logging.getSocketLogger(__name__)
 
 
-def current_command(cmd):
-    def deco(old_f):
-        @wraps(old_f)
-        def new_f(self, *args, **kwargs):
-            prev = self.current_command
-            self.current_command = cmd
-            ret = old_f(self, *args, **kwargs)
-            self.current_command = prev
-            return ret
-        return new_f
-    return deco
+def _create_connection(address):
+    # Commands and message data are already coalesced into as few writes as
+    # possible, so Nagle's algorithm would only delay them.
+    sock = create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class _CommandTimeout(Timeout):
+    # Unlike Timeout, exiting the context only cancels the timer so that the
+    # same object can be re-entered for every command on the connection.
+
+    def __exit__(self, typ, value, tb):
+        self.cancel()
 
 
 class SmtpRelayClient(RelayPoolClient):
@@ -64,10 +68,10 @@ class SmtpRelayClient(RelayPoolClient):
                  credentials=None, binary_encoder=None):
         super(SmtpRelayClient, self).__init__(queue, idle_timeout)
         self.address = address
-        self.socket_creator = socket_creator or create_connection
+        self.socket_creator = socket_creator or _create_connection
         self.socket = None
         self.client = None
-        self.ehlo_as = ehlo_as or socket.getfqdn()
+        self.ehlo_as = ehlo_as or get_hostname()
         self.context = context
         self.auth_mechanism = auth_mechanism
         self.tls_immediately = tls_immediately
@@ -75,67 +79,81 @@ class SmtpRelayClient(RelayPoolClient):
         self.connect_timeout = connect_timeout
         self.command_timeout = command_timeout
         self.data_timeout = data_timeout or command_timeout
+        self._command_timer = _CommandTimeout(self.command_timeout)
+        self._data_timer = _CommandTimeout(self.data_timeout)
         self.credentials = credentials
         self.binary_encoder = binary_encoder
         self.current_command = None
+        self._needs_rset = False
+        self._has_starttls = False
+        self._has_pipelining = False
+        self._has_8bitmime = False
 
-    @current_command(b'[CONNECT]')
     def _connect(self):
+        self.current_command = b'[CONNECT]'
         with Timeout(self.connect_timeout):
             self.socket = self.socket_creator(self.address)
         log.connect(self.socket, self.address)
         self.client = self._client_class(self.socket, self.address)
 
-    @current_command(b'[BANNER]')
     def _banner(self):
+        self.current_command = b'[BANNER]'
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             banner = self.client.get_banner()
         if banner.is_error():
             raise SmtpRelayError.factory(banner)
 
-    @current_command(b'EHLO')
     def _ehlo(self):
+        self.current_command = b'EHLO'
         assert self.ehlo_as is not None
-        try:
-            ehlo_as = self.ehlo_as(self.address)  # type: ignore
-        except TypeError:
+        if callable(self.ehlo_as):
+            ehlo_as = self.ehlo_as(self.address)
+        else:
             ehlo_as = self.ehlo_as
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             ehlo = self.client.ehlo(ehlo_as)
         if ehlo.is_error():
             if ehlo.code == '500':
                 return self._helo(ehlo_as)
             raise SmtpRelayError.factory(ehlo)
+        self._cache_extensions()
         return ehlo
 
-    @current_command(b'HELO')
     def _helo(self, ehlo_as):
+        self.current_command = b'HELO'
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             helo = self.client.helo(ehlo_as)
         if helo.is_error():
             raise SmtpRelayError.factory(helo)
+        self._cache_extensions()
         return helo
 
-    @current_command(b'STARTTLS')
+    def _cache_extensions(self):
+        extensions = self.client.extensions
+        self._has_starttls = 'STARTTLS' in extensions
+        self._has_pipelining = 'PIPELINING' in extensions
+        self._has_8bitmime = '8BITMIME' in extensions
+
     def _starttls(self):
+        self.current_command = b'STARTTLS'
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             starttls = self.client.starttls(self.context)
         if starttls.is_error() and self.tls_required:
             raise SmtpRelayError.factory(starttls)
 
-    @current_command(b'AUTH')
     def _authenticate(self):
+        self.current_command = b'AUTH'
         assert self.credentials is not None
-        try:
-            credentials = self.credentials()  # type: ignore
-        except TypeError:
+        if callable(self.credentials):
+            credentials = self.credentials()
+        else:
             credentials = self.credentials
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             auth = self.client.auth(*credentials,
                                     mechanism=self.auth_mechanism)
         if auth.is_error():
@@ -150,37 +168,50 @@ class SmtpRelayClient(RelayPoolClient):
         else:
             self._banner()
             self._ehlo()
-            if self.tls_required or 'STARTTLS' in self.client.extensions:
+            if self.tls_required or self._has_starttls:
                 self._starttls()
                 self._ehlo()
         if self.credentials:
             self._authenticate()
 
-    @current_command(b'RSET')
     def _rset(self):
+        self.current_command = b'RSET'
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             self.client.rset()
 
-    @current_command(b'MAIL')
+    def _defer_rset(self):
+        # Buffered commands or pending replies, such as the '.' ending an
+        # aborted DATA, mean the server is waiting on data that must be
+        # flushed now.
+        if self._has_pipelining and not self.client.reply_queue and \
+                not self.client.io.send_buffer.tell():
+            self._needs_rset = True
+        else:
+            self._rset()
+
     def _mailfrom(self, sender):
+        self.current_command = b'MAIL'
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
+            if self._needs_rset:
+                self._needs_rset = False
+                self.client.rset(pipeline=True)
             mailfrom = self.client.mailfrom(sender, auth=False)
         if mailfrom and mailfrom.is_error():
             raise SmtpRelayError.factory(mailfrom)
         return mailfrom
 
-    @current_command(b'RCPT')
     def _rcptto(self, rcpt):
+        self.current_command = b'RCPT'
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             return self.client.rcptto(rcpt)
 
-    @current_command(b'DATA')
     def _data(self):
+        self.current_command = b'DATA'
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             return self.client.data()
 
     def _check_replies(self, mailfrom, rcpttos, data):
@@ -194,33 +225,33 @@ class SmtpRelayClient(RelayPoolClient):
         if data.is_error():
             raise SmtpRelayError.factory(data)
 
-    @current_command(b'[SEND_DATA]')
     def _send_empty_data(self):
+        self.current_command = b'[SEND_DATA]'
         assert self.client is not None
-        with Timeout(self.data_timeout):
+        with self._data_timer:
             self.client.send_empty_data()
 
-    @current_command(b'[SEND_DATA]')
     def _send_message_data(self, envelope):
+        self.current_command = b'[SEND_DATA]'
         header_data, message_data = envelope.flatten()
         assert self.client is not None
-        with Timeout(self.data_timeout):
+        with self._data_timer:
             send_data = self.client.send_data(
                 header_data, message_data)
-        self.client._flush_pipeline()
+        if self.client.reply_queue:
+            self.client._flush_pipeline()
         if isinstance(send_data, Reply) and send_data.is_error():
             raise SmtpRelayError.factory(send_data)
         return send_data
 
     def _handle_encoding(self, envelope):
-        assert self.client is not None
-        if '8BITMIME' not in self.client.extensions:
+        if not self._has_8bitmime:
             try:
                 envelope.encode_7bit(self.binary_encoder)
             except UnicodeError:
-                reply = Reply('554', '5.6.3 Conversion not allowed',
-                              command=b'[data conversion]',
+                reply = Reply(command=b'[data conversion]',
                               address=self.address)
+                reply.copy(conversion_not_allowed)
                 raise SmtpRelayError.factory(reply)
 
     def _send_envelope(self, rcpt_results, envelope):
@@ -235,41 +266,44 @@ class SmtpRelayClient(RelayPoolClient):
                 self._send_empty_data()
             raise
         for i, rcpt_reply in enumerate(rcpttos):
-            rcpt = envelope.recipients[i]
             if rcpt_reply.is_error():
-                rcpt_results[rcpt] = SmtpRelayError.factory(rcpt_reply)
+                rcpt_results[i] = SmtpRelayError.factory(rcpt_reply)
 
     def _deliver(self, result, envelope):
-        rcpt_results = dict.fromkeys(envelope.recipients)
+        rcpt_results = [None] * len(envelope.recipients)
         try:
             self._handle_encoding(envelope)
             self._send_envelope(rcpt_results, envelope)
             msg_result = self._send_message_data(envelope)
         except SmtpRelayError as e:
             result.set_exception(e)
-            self._rset()
+            self._defer_rset()
         else:
-            for key, value in rcpt_results.items():
-                if value is None:
-                    rcpt_results[key] = msg_result
-            result.set(rcpt_results)
+            for i, rcpt_result in enumerate(rcpt_results):
+                if rcpt_result is None:
+                    rcpt_results[i] = msg_result
+            result.set(dict(zip(envelope.recipients, rcpt_results)))
 
     def _check_server_timeout(self):
+        self.current_command = None
         assert self.client is not None
         try:
             if self.client.has_reply_waiting():
-                with Timeout(self.command_timeout):
+                with self._command_timer:
                     self.client.get_reply()
                 return True
         except SmtpError:
             return True
         return False
 
-    def _disconnect(self):
+    def _disconnect(self, graceful=True):
         assert self.client is not None
         try:
-            with Timeout(self.command_timeout):
-                self.client.quit()
+            # A broken session may have a peer that stopped reading, so any
+            # unsent data is dropped and the socket closed without QUIT.
+            if graceful:
+                with self._command_timer:
+                    self.client.quit()
         except (Timeout, Exception):
             pass
         finally:
@@ -292,12 +326,14 @@ class SmtpRelayClient(RelayPoolClient):
         if not result:
             return
         reraise = True
+        graceful = True
         try:
             self._connect()
             self._handshake()
             while result:
                 if self._check_server_timeout():
                     self.queue.appendleft((result, envelope))
+                    graceful = False
                     break
                 self._deliver(result, envelope)
                 if self.idle_timeout is None:
@@ -306,17 +342,20 @@ class SmtpRelayClient(RelayPoolClient):
         except SmtpRelayError as e:
             result.set_exception(e)
         except SmtpError as e:
+            graceful = False
             if not result.ready():
                 reply = self._get_error_reply(e)
                 relay_error = SmtpRelayError.factory(reply)
                 result.set_exception(relay_error)
         except Timeout:
+            graceful = False
             if not result.ready():
                 reply = Reply(command=self.current_command,
                               address=self.address).copy(timed_out)
                 relay_error = SmtpRelayError.factory(reply)
                 result.set_exception(relay_error)
         except socket.error as exc:
+            graceful = False
             log.error(self.socket, exc, self.address)
             if not result.ready():
                 reply = Reply(command=self.current_command,
@@ -330,7 +369,7 @@ class SmtpRelayClient(RelayPoolClient):
             raise
         finally:
             try:
-                self._disconnect()
+                self._disconnect(graceful)
             except Exception:
                 if reraise:
                     raise
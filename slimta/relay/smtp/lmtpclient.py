@@ -21,8 +21,6 @@
 
 from __future__ import absolute_import
 
-from gevent import Timeout
-
 from slimta.smtp.client import LmtpClient
 from .client import SmtpRelayClient
 from . import SmtpRelayError
@@ -35,27 +33,30 @@ class LmtpRelayClient(SmtpRelayClient):
     _client_class = LmtpClient
 
     def _ehlo(self):
+        self.current_command = b'LHLO'
         assert self.ehlo_as is not None
-        try:
-            ehlo_as = self.ehlo_as(self.address)  # type: ignore
-        except TypeError:
+        if callable(self.ehlo_as):
+            ehlo_as = self.ehlo_as(self.address)
+        else:
             ehlo_as = self.ehlo_as
         assert self.client is not None
-        with Timeout(self.command_timeout):
+        with self._command_timer:
             lhlo = self.client.lhlo(ehlo_as)
         if lhlo.is_error():
             raise SmtpRelayError.factory(lhlo)
+        self._cache_extensions()
 
     def _deliver(self, result, envelope):
-        rcpt_results = dict.fromkeys(envelope.recipients)
+        rcpt_errors = [None] * len(envelope.recipients)
         try:
             self._handle_encoding(envelope)
-            self._send_envelope(rcpt_results, envelope)
+            self._send_envelope(rcpt_errors, envelope)
             data_results = self._send_message_data(envelope)
         except SmtpRelayError as e:
             result.set_exception(e)
-            self._rset()
+            self._defer_rset()
             return
+        rcpt_results = dict(zip(envelope.recipients, rcpt_errors))
         had_errors = False
         for rcpt, reply in data_results:  # type: ignore
             if reply.is_error():
@@ -65,7 +66,7 @@ class LmtpRelayClient(SmtpRelayClient):
                 rcpt_results[rcpt] = reply
         result.set(rcpt_results)
         if had_errors:
-            self._rset()
+            self._defer_rset()
 
 
 # vim:et:fdm=marker:sts=4:sw=4:ts=4
@@ -30,8 +30,13 @@ made by using the number of delivery attempts to cycle through the options.
 from __future__ import absolute_import
 
 import time
+from collections import OrderedDict
+from itertools import islice
+from operator import itemgetter
 
+import gevent
 from gevent import ssl
+from gevent.event import AsyncResult
 from pycares.errno import ARES_ENOTFOUND, ARES_ENODATA
 
 from slimta import logging
@@ -60,57 +65,139 @@ class NoDomainError(PermanentRelayError):
         self.recipient = recipient
 
 
+class _LruCache(OrderedDict):
+    # Once more than maxsize keys are stored, the least recently used key is
+    # discarded.
+
+    def __init__(self, maxsize=None):
+        super(_LruCache, self).__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super(_LruCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super(_LruCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize is not None and len(self) > self.maxsize:
+            self._evict()
+
+    def _evict(self):
+        self.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class _RelayerCache(_LruCache):
+    # Only relayers without clients in their pool are discarded, so that a
+    # destination never has two pools exceeding its pool_size. The relayer
+    # just added is about to be used, so it is never discarded.
+
+    def _evict(self):
+        for key, relayer in islice(self.items(), len(self) - 1):
+            if not relayer.pool:
+                del self[key]
+                return
+
+
 class MxRecord(object):
 
-    def __init__(self, domain):
+    def __init__(self, domain, negative_ttl=0, min_ttl=0, max_ttl=None):
         self.domain = domain
+        self.negative_ttl = negative_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
         self._records = None
         self._expiration = 0
+        self._refresh_at = 0
+        self._resolving = None
 
     def get(self):
         if self.expired:
-            self._records, self._expiration = self._resolve()
+            if self._resolving is None:
+                self._refresh()
+            else:
+                self._resolving.get()
+        elif self._resolving is None and time.time() >= self._refresh_at:
+            # Most of the TTL has passed, start resolving the records again
+            # in the background so that callers never have to wait for it.
+            self._refresh_at = self._expiration
+            gevent.spawn(self._refresh_ahead)
         if not self._records:
             msg = 'No usable DNS records found: '+self.domain
             raise ValueError(msg)
         return self._records
 
-    def _resolve_a(self):
-        answer = DNSResolver.query(self.domain, 'A').get()
-        expiration = 0
-        now = time.time()
+    def _refresh(self):
+        # Other greenlets asking for the same domain while the queries are in
+        # flight wait on this result instead of sending their own.
+        self._resolving = result = AsyncResult()
+        try:
+            records, ttl = self._resolve()
+            now = time.time()
+            self._records = records
+            self._expiration = now + ttl
+            self._refresh_at = now + ttl * 0.8
+        except Exception as exc:
+            result.set_exception(exc)
+            raise
+        finally:
+            self._resolving = None
+            if not result.ready():
+                result.set()
+
+    def _refresh_ahead(self):
+        try:
+            self._refresh()
+        except DNSError:
+            pass
+
+    def _clamp_ttl(self, ttl):
+        ttl = max(ttl, self.min_ttl)
+        if self.max_ttl is not None:
+            ttl = min(ttl, self.max_ttl)
+        return ttl
+
+    def _resolve_a(self, result):
+        answer = result.get()
+        ttl = 0
         ret = []
         for rdata in answer:
             ret.append((0, self.domain))
-            expiration = max(expiration, now + rdata.ttl)
-        return ret, expiration
+            ttl = max(ttl, rdata.ttl)
+        return ret, self._clamp_ttl(ttl)
 
-    def _resolve_mx(self):
-        answer = DNSResolver.query(self.domain, 'MX').get()
-        expiration = 0
-        now = time.time()
+    def _resolve_mx(self, result):
+        answer = result.get()
+        ttl = 0
         ret = []
         for rdata in answer:
-            for i, rec in enumerate(ret):
-                if rec[0] > rdata.priority:
-                    ret.insert(i, (rdata.priority, str(rdata.host)))
-                    break
-            else:
-                ret.append((rdata.priority, str(rdata.host)))
-            expiration = max(expiration, now + rdata.ttl)
-        return ret, expiration
+            ret.append((rdata.priority, str(rdata.host)))
+            ttl = max(ttl, rdata.ttl)
+        ret.sort(key=itemgetter(0))
+        return ret, self._clamp_ttl(ttl)
 
     def _resolve(self):
         non_fatal_errors = (ARES_ENOTFOUND, ARES_ENODATA)
+        # The A query is only used when there are no MX records, but sending
+        # both together saves a round-trip in that case.
+        mx_result = DNSResolver.query(self.domain, 'MX')
+        a_result = DNSResolver.query(self.domain, 'A')
         try:
-            return self._resolve_mx()
+            return self._resolve_mx(mx_result)
         except DNSError as exc:
             if exc.errno in non_fatal_errors:
                 try:
-                    return self._resolve_a()
+                    return self._resolve_a(a_result)
                 except DNSError as exc:
                     if exc.errno in non_fatal_errors:
-                        return None, 0
+                        return None, self.negative_ttl
                     raise
             raise
 
@@ -162,25 +249,79 @@ class MxSmtpRelay(Relay):
                            an argument to
                            :meth:`~slimta.envelope.Envelope.encode_7bit` when
                            conversion is necessary for the remote server.
+    :param negative_ttl: Time in seconds to remember that a domain has no
+                         usable MX or A records, so that deliveries to it fail
+                         without repeating the DNS queries.
+    :param min_ttl: Resolved records are cached for at least this many seconds,
+                    even if their DNS TTL is shorter.
+    :param max_ttl: Resolved records are cached for at most this many seconds,
+                    even if their DNS TTL is longer. ``None`` removes the
+                    limit.
+    :param max_domains: At most this many domains have their resolved records
+                        cached, the least recently used are forgotten first.
+                        ``None`` removes the limit.
+    :param max_relayers: At most this many destinations keep their
+                         :class:`~slimta.relay.smtp.static.StaticSmtpRelay`
+                         object, the least recently used are forgotten first.
+                         Destinations with open connections are never
+                         forgotten, so more may be kept while they are busy.
+                         By default, there is no limit.
 
     """
 
-    def __init__(self, context=None, **client_kwargs):
+    def __init__(self, context=None, negative_ttl=300.0, min_ttl=0,
+                 max_ttl=86400.0, max_domains=4096, max_relayers=None,
+                 **client_kwargs):
         super(MxSmtpRelay, self).__init__()
-        self._mx_records = {}
+        self.negative_ttl = negative_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self._mx_records = _LruCache(max_domains)
         self._force_mx = {}
-        self._relayers = {}
+        self._relayers = _RelayerCache(max_relayers)
         self._client_kwargs = client_kwargs
         self._client_kwargs['context'] = context or \
             ssl.create_default_context()
 
     def _get_rcpt_domain(self, envelope):
         rcpt = envelope.recipients[0]
-        try:
-            localpart, domain = rcpt.rsplit('@', 1)
-            return domain.lower()
-        except ValueError:
+        i = rcpt.rfind('@')
+        if i < 0 or i == len(rcpt) - 1:
             raise NoDomainError(rcpt)
+        return rcpt[i+1:].lower()
+
+    def _get_mx_record(self, domain):
+        record = self._mx_records.get(domain)
+        if record is None:
+            record = MxRecord(domain, self.negative_ttl,
+                              self.min_ttl, self.max_ttl)
+            self._mx_records[domain] = record
+        return record
+
+    def _prefetch_mx_record(self, record):
+        try:
+            record.get()
+        except (ValueError, DNSError):
+            pass
+
+    def prefetch(self, domains, timeout=None):
+        """Resolves the MX records of the given domains concurrently, so that
+        later delivery attempts to them do not wait on DNS. Lookup failures are
+        ignored here, they are reported by the delivery attempts instead.
+
+        :param domains: Iterable of domain strings.
+        :param timeout: Maximum time in seconds to wait for the lookups. Any
+                        lookups still running continue in the background.
+
+        """
+        records = {}
+        for domain in domains:
+            domain = domain.lower()
+            if domain not in self._force_mx and domain not in records:
+                records[domain] = self._get_mx_record(domain)
+        jobs = [gevent.spawn(self._prefetch_mx_record, record)
+                for record in records.values()]
+        gevent.joinall(jobs, timeout=timeout)
 
     def new_static_relay(self, destination, port):
         """Return a new :class:`~slimta.relay.smtp.static.StaticSmtpRelay`
@@ -222,10 +363,11 @@ class MxSmtpRelay(Relay):
 
     def attempt(self, envelope, attempts):
         domain = self._get_rcpt_domain(envelope)
-        if domain in self._force_mx:
-            dest, port = self._force_mx[domain]
+        forced = self._force_mx.get(domain) if self._force_mx else None
+        if forced is not None:
+            dest, port = forced
         else:
-            record = self._mx_records.setdefault(domain, MxRecord(domain))
+            record = self._get_mx_record(domain)
             try:
                 dest = self.choose_mx(record.get(), attempts)
             except ValueError as exc:
@@ -238,11 +380,11 @@ class MxSmtpRelay(Relay):
                 reply = Reply('451', '4.4.3 '+msg)
                 raise TransientRelayError(msg, reply)
             port = 25
-        try:
-            relayer = self._relayers[(dest, port)]
-        except KeyError:
+        key = (dest, port)
+        relayer = self._relayers.get(key)
+        if relayer is None:
             relayer = self.new_static_relay(dest, port)
-            self._relayers[(dest, port)] = relayer
+            self._relayers[key] = relayer
         return relayer.attempt(envelope, attempts)
 
 
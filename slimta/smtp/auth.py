@@ -21,8 +21,8 @@
 
 from __future__ import absolute_import
 
-import re
-import base64
+import string
+from binascii import a2b_base64, b2a_base64, Error as Base64Error
 
 from pysasl.mechanism import ServerChallenge, ChallengeResponse
 from pysasl.creds.client import ClientCredentials
@@ -33,8 +33,18 @@ from .reply import Reply
 
 __all__ = ['ServerAuthError', 'AuthSession']
 
-noarg_pattern = re.compile(br'^([a-zA-Z0-9_-]+)$')
-witharg_pattern = re.compile(br'^([a-zA-Z0-9_-]+)\s+(.+)$')
+_mechanism_chars = (string.ascii_letters + string.digits + '_-').encode()
+
+
+# These replies are shared by every raised error, like the predefined replies
+# in slimta.smtp.reply, and must not be modified.
+_invalid_auth_string = Reply('501', '5.5.2 Invalid authentication string')
+_insecure_mechanism = Reply(
+    '504', '5.5.4 Insecure authentication mechanism requires SSL')
+_invalid_mechanism = Reply('504', '5.5.4 Invalid authentication mechanism')
+_authentication_canceled = Reply(
+    '501', '5.7.0 Authentication canceled by client')
+_empty_challenge = Reply('334', '')
 
 
 class ServerAuthError(SmtpError):
@@ -48,32 +58,29 @@ class InvalidAuthString(ServerAuthError):
 
     def __init__(self):
         msg = 'Invalid authentication string'
-        reply = Reply('501', '5.5.2 '+msg)
-        super(InvalidAuthString, self).__init__(msg, reply)
+        super(InvalidAuthString, self).__init__(msg, _invalid_auth_string)
 
 
 class InsecureMechanismError(ServerAuthError):
 
     def __init__(self):
         msg = 'Insecure authentication mechanism requires SSL'
-        reply = Reply('504', '5.5.4 '+msg)
-        super(InsecureMechanismError, self).__init__(msg, reply)
+        super(InsecureMechanismError, self).__init__(msg, _insecure_mechanism)
 
 
 class InvalidMechanismError(ServerAuthError):
 
     def __init__(self):
         msg = 'Invalid authentication mechanism'
-        reply = Reply('504', '5.5.4 '+msg)
-        super(InvalidMechanismError, self).__init__(msg, reply)
+        super(InvalidMechanismError, self).__init__(msg, _invalid_mechanism)
 
 
 class AuthenticationCanceled(ServerAuthError):
 
     def __init__(self):
         msg = 'Authentication canceled by client'
-        reply = Reply('501', '5.7.0 '+msg)
-        super(AuthenticationCanceled, self).__init__(msg, reply)
+        super(AuthenticationCanceled, self).__init__(
+            msg, _authentication_canceled)
 
 
 class UnexpectedAuthError(ServerAuthError):
@@ -98,12 +105,11 @@ class AuthSession(object):
             raise ValueError('No mechanisms available')
 
     def _parse_arg(self, arg):
-        match = noarg_pattern.match(arg)
-        if match:
-            return match.group(1).upper(), None
-        match = witharg_pattern.match(arg)
-        if match:
-            return match.group(1).upper(), match.group(2)
+        parts = arg.split(None, 1)
+        if parts and not parts[0].translate(None, _mechanism_chars):
+            if len(parts) == 1:
+                return parts[0].upper(), None
+            return parts[0].upper(), parts[1]
         raise InvalidMechanismError()
 
     @property
@@ -116,14 +122,18 @@ class AuthSession(object):
 
     def _server_challenge(self, challenge, response=None):
         if not response:
-            challenge_raw = base64.b64encode(challenge).decode('ascii')
-            Reply('334', challenge_raw).send(self.io, flush=True)
+            if challenge:
+                challenge_raw = b2a_base64(challenge, newline=False)
+                challenge_raw = challenge_raw.decode('ascii')
+                Reply('334', challenge_raw).send(self.io, flush=True)
+            else:
+                _empty_challenge.send(self.io, flush=True)
             response = self.io.recv_line()
         if response == b'*':
             raise AuthenticationCanceled()
         try:
-            return base64.b64decode(response)
-        except TypeError:
+            return a2b_base64(response)
+        except Base64Error:
             raise InvalidAuthString()
 
     def server_attempt(self, arg):
@@ -150,16 +160,16 @@ class AuthSession(object):
         if first:
             command = b' '.join((b'AUTH', mech.name))
             if response:
-                response_raw = base64.b64encode(response)
+                response_raw = b2a_base64(response, newline=False)
                 command = b' '.join((command, response_raw))
         else:
-            command = base64.b64encode(response)
+            command = b2a_base64(response, newline=False)
         self.io.send_command(command)
         self.io.flush_send()
         ret = Reply(command=b'AUTH')
         ret.recv(self.io)
         if ret.code == '334':
-            return base64.b64decode(ret.message), ret
+            return a2b_base64(ret.message), ret
         return None, ret
 
     def client_attempt(self, authcid, secret, authzid, mech_name):
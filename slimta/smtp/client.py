@@ -273,8 +273,10 @@ class Client(object):
         advertised = [self._encode(mech_name)
                       for mech_name in auth_ext.split()]
         auth = AuthSession(SASLAuth.named(advertised), self.io)
-        if not mechanism and auth.client_mechanisms:
-            mechanism = auth.client_mechanisms[0].name
+        if not mechanism:
+            client_mechanisms = auth.client_mechanisms
+            if client_mechanisms:
+                mechanism = client_mechanisms[0].name
         return auth.client_attempt(authcid, secret, authzid, mechanism)
 
     def mailfrom(self, address, data_size=None, auth=None):
@@ -387,14 +389,25 @@ class Client(object):
 
         return send_data
 
-    def rset(self):
+    def rset(self, pipeline=False):
         """Sends a RSET command and waits for the response. The intent of the
         RSET command is to reset any :meth:`mail` or :meth:`rcpt` commands that
         are pending.
 
-        :returns: |Reply| object populated with the response.
+        :param pipeline: If True and the server supports PIPELINING, the
+                         command is buffered and sent along with the next
+                         non-pipelined command instead of waiting for the
+                         response.
+        :returns: |Reply| object populated with the response, or that will be
+                  populated once a non-pipelined command is called if
+                  ``pipeline`` was used.
 
         """
+        if pipeline and 'PIPELINING' in self.extensions:
+            rset = Reply(command=b'RSET')
+            self.reply_queue.append(rset)
+            self.io.send_command(b'RSET')
+            return rset
         return self.custom_command(b'RSET')
 
     def quit(self):
@@ -484,8 +497,8 @@ class LmtpClient(Client):
 
         return ret
 
-    def rset(self):
-        reply = super(LmtpClient, self).rset()
+    def rset(self, pipeline=False):
+        reply = super(LmtpClient, self).rset(pipeline)
         self.rcpttos = []
         return reply
 
@@ -21,10 +21,13 @@
 
 from __future__ import absolute_import
 
+import re
 from itertools import chain
 
 __all__ = ['DataSender']
 
+_line_period = re.compile(br'^\.', re.M)
+
 
 class DataSender(object):
     """Class that writes multi-line message data, taking care of dot marker
@@ -52,23 +55,11 @@ class DataSender(object):
             self.end_marker = b'\r\n.\r\n'
 
     def _process_part(self, part):
-        part_len = len(part)
-        i = 0
-        if part_len > 0 and part[0:1] == b'.':
-            yield b'.'
-        while i < part_len:
-            index = part.find(b'\n.', i)
-            if index == -1:
-                yield part if i == 0 else part[i:]
-                i = part_len
-            else:
-                yield part[i:index+2]
-                yield b'.'
-                i = index+2
+        return _line_period.sub(b'..', part)
 
     def __iter__(self):
-        parts = [self._process_part(part) for part in self.parts]
-        return chain(chain.from_iterable(parts), (self.end_marker, ))
+        parts = map(self._process_part, self.parts)
+        return chain(parts, (self.end_marker, ))
 
     def send(self, io):
         for piece in self:
@@ -47,6 +47,17 @@ command_arg_pattern = re.compile(br'^([a-zA-Z]+)\s+(.+?)\s*$')
 
 log = logging.getSocketLogger(__name__)
 
+#: Buffered data at least this large is kept as its own segment rather than
+#: copied into the send buffer, and written with scatter-gather I/O.
+_SEGMENT_THRESHOLD = 8192
+
+_IOV_MAX = 1024
+
+#: Maximum bytes requested from the socket per read. Everything the peer has
+#: already sent, such as a group of pipelined replies or a large chunk of
+#: message data, is consumed by one read and parsed from the buffer.
+_RECV_SIZE = 65536
+
 
 class IO(object):
 
@@ -55,6 +66,7 @@ class IO(object):
         self._address = address
 
         self.send_buffer = BytesIO()
+        self.send_segments = []
         self.recv_buffer = b''
 
     @property
@@ -90,9 +102,31 @@ class IO(object):
             raise
         log.send(self.socket, data)
 
+    def raw_send_segments(self, segments):
+        if self.encrypted or not hasattr(self.socket, 'sendmsg'):
+            for segment in segments:
+                self.raw_send(segment)
+            return
+        views = [memoryview(segment) for segment in segments]
+        first = 0
+        try:
+            while first < len(views):
+                sent = self.socket.sendmsg(views[first:first+_IOV_MAX])
+                while first < len(views) and sent >= len(views[first]):
+                    sent -= len(views[first])
+                    first += 1
+                if sent:
+                    views[first] = views[first][sent:]
+        except socket_error as e:
+            if e.errno == ECONNRESET:
+                raise ConnectionLost()
+            raise
+        for segment in segments:
+            log.send(self.socket, segment)
+
     def raw_recv(self):
         try:
-            data = self.socket.recv(4096)
+            data = self.socket.recv(_RECV_SIZE)
         except socket_error as e:
             if e.errno == ECONNRESET:
                 raise ConnectionLost()
@@ -127,15 +161,30 @@ class IO(object):
         received = self.raw_recv()
         self.recv_buffer += received
 
+    def _end_segment(self):
+        data = self.send_buffer.getvalue()
+        if data:
+            self.send_segments.append(data)
+            self.send_buffer = BytesIO()
+
     def buffered_send(self, data):
-        self.send_buffer.write(data)
+        if len(data) >= _SEGMENT_THRESHOLD:
+            self._end_segment()
+            self.send_segments.append(data)
+        else:
+            self.send_buffer.write(data)
 
     def flush_send(self):
-        send = self.send_buffer.getvalue()
-        if send == b'':
+        if not self.send_segments:
+            send = self.send_buffer.getvalue()
+            if send == b'':
+                return
+            self.raw_send(send)
+            self.send_buffer = BytesIO()
             return
-        self.raw_send(send)
-        self.send_buffer = BytesIO()
+        self._end_segment()
+        segments, self.send_segments = self.send_segments, []
+        self.raw_send_segments(segments)
 
     def recv_reply(self):
         body = None
@@ -150,16 +199,15 @@ class IO(object):
                 match = reply_line_pattern.match(input, start_i)
                 if match:
                     if code and code != match.group(2):
+                        self.recv_buffer = input[start_i:]
                         raise BadReply(match.group(1))
                     code = match.group(2)
                     message_lines.append(match.group(4))
-                    self.recv_buffer = input[match.end(0):]
+                    start_i = match.end(0)
 
                     if match.group(3) != b'-':
                         incomplete = False
-                        start_i = None
-                    else:
-                        start_i = match.end(0)
+                        break
                 else:
                     match = line_pattern.match(input, start_i)
                     if match:
@@ -167,7 +215,12 @@ class IO(object):
                         message_lines.append(match.group(1))
                         raise BadReply(b'\r\n'.join(message_lines))
                     else:
-                        start_i = None
+                        break
+
+            # Only slice the consumed lines off once per buffer, rather than
+            # once per line of a multi-line reply.
+            if start_i:
+                self.recv_buffer = input[start_i:]
 
             if incomplete:
                 self.buffered_recv()
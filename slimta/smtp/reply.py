@@ -32,7 +32,8 @@ import re
 
 __all__ = ['Reply', 'unknown_command', 'unknown_parameter', 'bad_sequence',
                     'bad_arguments', 'timed_out', 'unhandled_error',
-                    'connection_failed', 'tls_failure', 'invalid_credentials']
+                    'connection_failed', 'tls_failure', 'invalid_credentials',
+                    'conversion_not_allowed']
 
 message_esc_pattern = re.compile(r'^([245]\.\d\d?\d?\.\d\d?\d?)\s+')
 esc_pattern = re.compile(r'^([245])\.(\d\d?\d?)\.(\d\d?\d?)$')
@@ -270,5 +271,8 @@ timed_out.newline_first = True
 invalid_credentials = Reply(
     '535', '5.7.8 Authentication credentials invalid')
 
+#: Reply used when message data requires a conversion that cannot be done.
+conversion_not_allowed = Reply('554', '5.6.3 Conversion not allowed')
+
 
 # vim:et:fdm=marker:sts=4:sw=4:ts=4
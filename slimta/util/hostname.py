@@ -0,0 +1,48 @@
+# Copyright (c) 2026 Ian C. Good
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Provides the fully-qualified hostname of the local machine, used by default
+to identify this machine in greetings, headers, and bounce messages.
+
+"""
+
+from __future__ import absolute_import
+
+from functools import lru_cache
+
+from gevent import socket
+
+__all__ = ['get_hostname']
+
+
+@lru_cache(maxsize=None)
+def get_hostname():
+    """Returns the hostname of the local machine, as given by
+    :func:`~socket.getfqdn()`. The result is looked up on the first call and
+    re-used after that.
+
+    :rtype: str
+
+    """
+    return socket.getfqdn()
+
+
+# vim:et:fdm=marker:sts=4:sw=4:ts=4
@@ -0,0 +1,148 @@
+# Copyright (c) 2026 Ian C. Good
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Provides a growable ring buffer that blocks consumers until an item is
+available, suitable for handing delivery requests to a pool of greenlets.
+
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+
+from gevent import get_hub
+from gevent.hub import Waiter
+
+__all__ = ['GeventRing']
+
+
+class GeventRing(object):
+    """A FIFO ring buffer of items, backed by a pre-allocated list whose size
+    is a power of two. Because greenlets sharing a hub never run concurrently,
+    the head and tail indexes are updated without any locking.
+
+    When consumers are blocked waiting on an empty ring, new items are handed
+    directly to the longest-waiting consumer and never stored in the ring, so
+    only one consumer is woken up per item.
+
+    The ring doubles in size whenever it is full, so producers never block.
+
+    :param size: The initial number of slots, rounded up to a power of two.
+
+    """
+
+    def __init__(self, size=16):
+        capacity = 1
+        while capacity < size:
+            capacity <<= 1
+        self._items = [None] * capacity
+        self._mask = capacity - 1
+        self._head = 0
+        self._tail = 0
+        self._waiters = deque()
+
+    def __len__(self):
+        return self._tail - self._head
+
+    @property
+    def waiting(self):
+        """The number of consumers currently blocked in :meth:`popleft`."""
+        return len(self._waiters)
+
+    def __iter__(self):
+        for i in range(self._head, self._tail):
+            yield self._items[i & self._mask]
+
+    def _grow(self):
+        items = list(self)
+        capacity = (self._mask + 1) << 1
+        self._items = items + [None] * (capacity - len(items))
+        self._mask = capacity - 1
+        self._head = 0
+        self._tail = len(items)
+
+    def _handoff(self, item):
+        if not self._waiters:
+            return False
+        waiter = self._waiters.popleft()
+        get_hub().loop.run_callback(waiter.switch, item)
+        return True
+
+    def _requeue(self, waiter):
+        self.appendleft(waiter.get())
+
+    def append(self, item):
+        """Adds an item to the end of the ring, handing it directly to a
+        waiting consumer if there is one.
+
+        :param item: The item to add.
+
+        """
+        if self._handoff(item):
+            return
+        if self._tail - self._head > self._mask:
+            self._grow()
+        self._items[self._tail & self._mask] = item
+        self._tail += 1
+
+    def appendleft(self, item):
+        """Adds an item to the front of the ring, so that it is the next item
+        consumed.
+
+        :param item: The item to add.
+
+        """
+        if self._handoff(item):
+            return
+        if self._tail - self._head > self._mask:
+            self._grow()
+        self._head -= 1
+        self._items[self._head & self._mask] = item
+
+    def popleft(self):
+        """Removes and returns the item at the front of the ring, blocking
+        until one is available.
+
+        """
+        if self._head == self._tail:
+            return self._wait()
+        index = self._head & self._mask
+        item = self._items[index]
+        self._items[index] = None
+        self._head += 1
+        return item
+
+    def _wait(self):
+        waiter = Waiter()
+        self._waiters.append(waiter)
+        try:
+            return waiter.get()
+        except BaseException:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                # An item was handed off before the wait was interrupted, put
+                # it back once the hand-off has been delivered to the waiter.
+                get_hub().loop.run_callback(self._requeue, waiter)
+            raise
+
+
+# vim:et:fdm=marker:sts=4:sw=4:ts=4
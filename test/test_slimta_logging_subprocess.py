@@ -1,6 +1,7 @@
+import logging
 import unittest
 
-from testfixtures import log_capture
+from testfixtures import log_capture, LogCapture
 
 from slimta.logging import getSubprocessLogger
 
@@ -36,5 +37,13 @@ class TestSocketLogger(unittest.TestCase):
         self.log.exit(p)
         l.check(('test', 'DEBUG', 'pid:299:exit returncode=13'))
 
+    def test_debug_disabled(self):
+        p = FakeSubprocess(828, 0)
+        with LogCapture(level=logging.INFO) as l:
+            self.log.popen(p, ['one', 'two'])
+            self.log.stdio(p, 'one', 'two', '')
+            self.log.exit(p)
+        l.check()
+
 
 # vim:et:fdm=marker:sts=4:sw=4:ts=4
@@ -2,6 +2,8 @@ import unittest
 from mox import MoxTestBase, IsA
 
 from slimta.relay import Relay, PermanentRelayError, TransientRelayError
+from slimta.relay.smtp import SmtpRelayError
+from slimta.smtp.reply import Reply
 from slimta.policy import RelayPolicy
 from slimta.envelope import Envelope
 
@@ -14,6 +16,16 @@ class TestRelay(MoxTestBase, unittest.TestCase):
         self.assertEqual('550 5.0.0 test msg', str(perm.reply))
         self.assertEqual('450 4.0.0 test msg', str(transient.reply))
 
+    def test_smtp_relay_error(self):
+        perm = SmtpRelayError.factory(Reply('550', '5.0.0 Nope', b'RCPT'))
+        transient = SmtpRelayError.factory(Reply('450', '4.0.0 Later'))
+        self.assertIsInstance(perm, PermanentRelayError)
+        self.assertIsInstance(transient, TransientRelayError)
+        self.assertEqual('Permanent failure on RCPT: 550 5.0.0 Nope', str(perm))
+        self.assertEqual('Transient failure on [unknown command]: 450 4.0.0 Later', transient.msg)
+        self.assertEqual("SmtpTransientRelayError('Transient failure on [unknown command]: 450 4.0.0 Later')", repr(transient))
+        self.assertEqual(('Permanent failure on RCPT: 550 5.0.0 Nope', ), perm.args)
+
     def test_policies(self):
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         p1 = self.mox.CreateMock(RelayPolicy)
@@ -5,7 +5,7 @@ from gevent.event import AsyncResult
 from gevent import Timeout
 
 from slimta.envelope import Envelope
-from slimta.util.deque import BlockingDeque
+from slimta.util.ring import GeventRing
 from slimta.smtp.reply import Reply
 from slimta.relay import PermanentRelayError, TransientRelayError
 from slimta.relay.http import HttpRelay, HttpRelayClient
@@ -23,7 +23,7 @@ class TestHttpRelayClient(MoxTestBase, unittest.TestCase):
 
     def setUp(self):
         super(TestHttpRelayClient, self).setUp()
-        self.queue = self.mox.CreateMock(BlockingDeque)
+        self.queue = self.mox.CreateMock(GeventRing)
         class FakeRelay(object):
             queue = self.queue
             idle_timeout = None
@@ -60,6 +60,7 @@ class TestHttpRelayClient(MoxTestBase, unittest.TestCase):
         self.mox.StubOutWithMock(self.client, '_process_response')
         conn = self.client.conn = self.mox.CreateMockAnything()
         self.client.ehlo_as = 'test'
+        self.client._static_headers = self.client._build_static_headers()
         conn.putrequest('POST', '/path/info')
         conn.putheader(b'Content-Length', b'31')
         conn.putheader(b'Content-Type', b'message/rfc822')
@@ -79,6 +80,8 @@ class TestHttpRelayClient(MoxTestBase, unittest.TestCase):
         http_res.getheader('X-Smtp-Reply', '').AndReturn('250; message="2.0.0 Ok"')
         http_res.getheader('X-Smtp-Reply', '').AndReturn('550; message="5.0.0 Nope" command="smtpcmd"')
         http_res.getheader('X-Smtp-Reply', '').AndReturn('asdf')
+        http_res.getheader('X-Smtp-Reply', '').AndReturn(' 451 ; Message = "4.0.0 Try later"')
+        http_res.getheader('X-Smtp-Reply', '').AndReturn('')
         self.mox.ReplayAll()
         reply1 = self.client._parse_smtp_reply_header(http_res)
         self.assertEqual('250', reply1.code)
@@ -90,6 +93,12 @@ class TestHttpRelayClient(MoxTestBase, unittest.TestCase):
         self.assertEqual('smtpcmd', reply2.command)
         reply3 = self.client._parse_smtp_reply_header(http_res)
         self.assertEqual(None, reply3)
+        reply4 = self.client._parse_smtp_reply_header(http_res)
+        self.assertEqual('451', reply4.code)
+        self.assertEqual('4.0.0 Try later', reply4.message)
+        self.assertEqual(None, reply4.command)
+        reply5 = self.client._parse_smtp_reply_header(http_res)
+        self.assertEqual(None, reply5)
 
     def test_process_response_200(self):
         http_res = self.mox.CreateMockAnything()
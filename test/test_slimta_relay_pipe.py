@@ -1,28 +1,98 @@
+import os
+import signal
+from io import BytesIO
 import unittest
-from mox import MoxTestBase
+from testfixtures import log_capture
+from mox import MoxTestBase, IsA
+import gevent
 from gevent import Timeout
+from gevent.event import AsyncResult
+from gevent.fileobject import FileObject
 from gevent import subprocess
 
-from slimta.relay.pipe import PipeRelay, MaildropRelay, DovecotLdaRelay
+from slimta.relay import pipe
+from slimta.relay.pipe import PipeRelay, PersistentPipeRelay, \
+    PipeWorkerClient, MaildropRelay, DovecotLdaRelay, _is_permanent, \
+    _read_bounded
 from slimta.relay import TransientRelayError, PermanentRelayError
 from slimta.envelope import Envelope
 
 
+def _mock_process(mox, returncode, stdout, stderr=''):
+    pmock = mox.CreateMockAnything()
+    pmock.stdin = mox.CreateMockAnything()
+    pmock.stdout = mox.CreateMockAnything()
+    pmock.stderr = mox.CreateMockAnything()
+    if pipe._writev_supported:
+        pmock.stdin.fileno().AndReturn(13)
+        pipe._writev_all(13, [b'From: sender@example.com\r\n\r\n',
+                              b'test test\r\n'])
+    else:
+        pmock.stdin.write(b'From: sender@example.com\r\n\r\n')
+        pmock.stdin.write(b'test test\r\n')
+    pmock.stdin.close()
+    pmock.stdout.read(65536).AndReturn(stdout)
+    pmock.stderr.read(65536).AndReturn(stderr)
+    pmock.wait()
+    pmock.stdout.close()
+    pmock.stderr.close()
+    pmock.pid = -1
+    pmock.returncode = returncode
+    return pmock
+
+
+class TestIsPermanent(unittest.TestCase):
+
+    def test_is_permanent(self):
+        self.assertTrue(_is_permanent('5.0.0 permanent'))
+        self.assertTrue(_is_permanent('5.12.345\tpermanent'))
+        self.assertFalse(_is_permanent('4.0.0 transient'))
+        self.assertFalse(_is_permanent('5.0.0'))
+        self.assertFalse(_is_permanent('5.0 permanent'))
+        self.assertFalse(_is_permanent('5..0 permanent'))
+        self.assertFalse(_is_permanent('5.0. permanent'))
+        self.assertFalse(_is_permanent('5.0.0x permanent'))
+        self.assertFalse(_is_permanent(''))
+
+
+class TestReadBounded(unittest.TestCase):
+
+    def test_read_bounded(self):
+        self.assertEqual(b'short', _read_bounded(BytesIO(b'short'), 8))
+        fileobj = BytesIO(b'0123456789' * 5)
+        self.assertEqual(b'01234567', _read_bounded(fileobj, 8))
+        self.assertEqual(b'', fileobj.read())
+
+
+class TestWritevAll(unittest.TestCase):
+
+    @unittest.skipUnless(pipe._writev_supported, 'requires os.writev')
+    def test_writev_all(self):
+        read_fd, write_fd = os.pipe()
+        data = [b'', b'x' * 100000, b'', b'y' * 100000]
+        reader = gevent.spawn(self._read_all, read_fd)
+        pipe._writev_all(write_fd, data)
+        os.close(write_fd)
+        self.assertEqual(b''.join(data), reader.get())
+
+    def _read_all(self, fd):
+        with FileObject(fd, 'rb') as f:
+            return f.read()
+
+
 class TestPipeRelay(MoxTestBase, unittest.TestCase):
 
     def _mock_popen(self, rcpt, returncode, stdout):
-        pmock = self.mox.CreateMockAnything()
+        pmock = _mock_process(self.mox, returncode, stdout)
         subprocess.Popen(['relaytest', '-f', 'sender@example.com', rcpt],
                          stdin=subprocess.PIPE,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE).AndReturn(pmock)
-        pmock.communicate(b'From: sender@example.com\r\n\r\ntest test\r\n').AndReturn((stdout, ''))
-        pmock.pid = -1
-        pmock.returncode = returncode
         return pmock
 
     def test_attempt(self):
         self.mox.StubOutWithMock(subprocess, 'Popen')
+        self.mox.StubOutWithMock(pipe, '_writev_all')
         env = Envelope('sender@example.com', ['rcpt1@example.com', 'rcpt2@example.com', 'rcpt3@example.com', 'rcpt4@example.com', 'rcpt5@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
         self._mock_popen('rcpt1@example.com', 0, '')
@@ -35,6 +105,7 @@ class TestPipeRelay(MoxTestBase, unittest.TestCase):
                          stderr=subprocess.PIPE).AndRaise(Timeout)
         self.mox.ReplayAll()
         m = PipeRelay(['relaytest', '-f', '{sender}', '{recipient}'])
+        m._posix_spawn = False
         results = m.attempt(env, 0)
         self.assertEqual(5, len(results))
         self.assertEqual(None, results['rcpt1@example.com'])
@@ -51,23 +122,230 @@ class TestPipeRelay(MoxTestBase, unittest.TestCase):
         self.assertEqual('Delivery timed out', str(results['rcpt5@example.com']))
         self.assertEqual('450', results['rcpt5@example.com'].reply.code)
 
+    @log_capture()
+    def test_attempt_logs_stdin(self, l):
+        self.mox.StubOutWithMock(subprocess, 'Popen')
+        self.mox.StubOutWithMock(pipe, '_writev_all')
+        env = Envelope('sender@example.com', ['rcpt1@example.com'])
+        env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
+        self._mock_popen('rcpt1@example.com', 0, b'')
+        self.mox.ReplayAll()
+        m = PipeRelay(['relaytest', '-f', '{sender}', '{recipient}'])
+        m._posix_spawn = False
+        m.attempt(env, 0)
+        stdio = [r.getMessage() for r in l.records if ':stdio ' in r.getMessage()]
+        self.assertEqual(1, len(stdio))
+        self.assertIn("stdin=b'From: sender@example.com\\r\\n\\r\\ntest test\\r\\n'", stdio[0])
+
+    def test_process_args(self):
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        env.parse(b'Message-Id: <test@example.com>\r\n\r\ntest test\r\n')
+        env.client['ip'] = '1.2.3.4'
+        m = PipeRelay(['relaytest', '--id={message_id}', '{{literal}}',
+                       '{client_ip}:{client_host!r}', '{recipient:>18}'])
+        macros = m._get_macros(env)
+        macros['recipient'] = 'rcpt@example.com'
+        self.assertEqual(['relaytest', '--id=<test@example.com>', '{literal}',
+                          "1.2.3.4:''", '  rcpt@example.com'],
+                         m._process_args(macros))
+
+    def test_process_args_field_access(self):
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        m = PipeRelay(['relaytest', '{sender[0]}', '{recipient.__class__.__name__}',
+                       '{recipient:>{client_ip}}', '{sender.__class__.__name__}'])
+        env.client['ip'] = '18'
+        macros = m._get_macros(env)
+        self.assertEqual({'sender': 'sender@example.com', 'client_ip': '18', 'recipient': None}, macros)
+        self.assertEqual([False, False, True, True, False], m._rcpt_args)
+        macros['recipient'] = 'rcpt@example.com'
+        self.assertEqual(['relaytest', 's', 'str', '  rcpt@example.com', 'str'],
+                         m._process_args(macros))
+        with self.assertRaises(KeyError):
+            PipeRelay(['relaytest', '{bad[0]}'])
+        with self.assertRaises(KeyError):
+            PipeRelay(['relaytest', '{sender:{bad}}'])
+
+    def test_format_static(self):
+        env = Envelope('sender@example.com', ['rcpt1@example.com', 'rcpt2@example.com'])
+        m = PipeRelay(['relaytest', '-f', '{sender}', '-d', '{recipient}', '--to={recipient!r}'])
+        macros = m._get_macros(env)
+        self.assertEqual({'sender': 'sender@example.com', 'recipient': None}, macros)
+        static_args = m._format_static(macros)
+        self.assertEqual(['relaytest', '-f', 'sender@example.com', '-d', None, None], static_args)
+        macros['recipient'] = 'rcpt2@example.com'
+        self.assertEqual(['relaytest', '-f', 'sender@example.com', '-d', 'rcpt2@example.com', "--to='rcpt2@example.com'"],
+                         m._process_args(macros, static_args))
+
+    @unittest.skipUnless(hasattr(os, 'posix_spawnp'), 'requires posix_spawnp')
+    def test_attempt_posix_spawn(self):
+        env = Envelope('sender@example.com', ['rcpt1@example.com', 'rcpt2@example.com'])
+        env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
+        m = PipeRelay(['sh', '-c', 'test "$(cat)" = "$1" || exit 1; echo "$2"; exit $3',
+                       'sh', 'From: sender@example.com\r\n\r\ntest test\r', '5.0.0 {recipient}', '{client_ip}'])
+        self.assertTrue(m._posix_spawn)
+        env.client['ip'] = '0'
+        results = m.attempt(env, 0)
+        self.assertEqual({'rcpt1@example.com': None, 'rcpt2@example.com': None}, results)
+        env.client['ip'] = '13'
+        results = m.attempt(env, 0)
+        self.assertIsInstance(results['rcpt1@example.com'], PermanentRelayError)
+        self.assertEqual('5.0.0 rcpt1@example.com', str(results['rcpt1@example.com']))
+        self.assertEqual('5.0.0 rcpt2@example.com', str(results['rcpt2@example.com']))
+
+    @unittest.skipUnless(hasattr(os, 'posix_spawnp') and os.path.exists('/proc/self/status'),
+                         'requires posix_spawnp and procfs')
+    def test_spawned_process_environment(self):
+        inherited_r, inherited_w = os.pipe()
+        os.set_inheritable(inherited_w, True)
+        try:
+            p = pipe._SpawnedProcess(['sh', '-c', '[ -e /proc/self/fd/$0 ] || '
+                                      'sed -n "s/^SigIgn:[[:space:]]*//p" /proc/self/status',
+                                      str(inherited_w)])
+            p.stdin.close()
+            sigign = p.stdout.read()
+            p.stdout.close()
+            p.stderr.close()
+            self.assertEqual(0, p.wait())
+            self.assertFalse(int(sigign, 16) & (1 << (signal.SIGPIPE - 1)))
+            self.assertFalse(int(sigign, 16) & (1 << (signal.SIGXFSZ - 1)))
+        finally:
+            os.close(inherited_r)
+            os.close(inherited_w)
+
+    def test_popen_kwargs_disable_posix_spawn(self):
+        m = PipeRelay(['relaytest'], cwd='/')
+        self.assertFalse(m._posix_spawn)
+
+    def test_unknown_macro(self):
+        with self.assertRaises(KeyError):
+            PipeRelay(['relaytest', '{unknown}'])
+
+
+class TestPersistentPipeRelay(MoxTestBase, unittest.TestCase):
+
+    def setUp(self):
+        super(TestPersistentPipeRelay, self).setUp()
+        self.relay = PersistentPipeRelay(['relaytest'], idle_timeout=10.0)
+        self.client = PipeWorkerClient(self.relay)
+        self.env = Envelope('sender@example.com', ['rcpt1@example.com', 'rcpt2@example.com'])
+        self.env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
+
+    def test_add_client(self):
+        self.assertIsInstance(self.relay.add_client(), PipeWorkerClient)
+
+    def test_macro_args(self):
+        with self.assertRaises(ValueError):
+            PersistentPipeRelay(['relaytest', '-f', '{sender}'])
+        with self.assertRaises(ValueError):
+            PersistentPipeRelay(['relaytest', '{recipient}'])
+        with self.assertRaises(ValueError):
+            PersistentPipeRelay(['relaytest', '--id={message_id}'])
+        relay = PersistentPipeRelay(['relaytest', '{{literal}}'])
+        self.assertEqual(['relaytest', '{{literal}}'], relay.args)
+
+    def _expect_frame(self, pmock, rcpt, ack):
+        pmock.stdin.write('18 {0} 39\n'.format(len(rcpt)).encode('ascii'))
+        pmock.stdin.write(b'sender@example.com')
+        pmock.stdin.write(rcpt)
+        pmock.stdin.write(b'From: sender@example.com\r\n\r\n')
+        pmock.stdin.write(b'test test\r\n')
+        pmock.stdin.flush()
+        pmock.stdout.readline().AndReturn(ack)
+
+    def test_deliver(self):
+        self.mox.StubOutWithMock(subprocess, 'Popen')
+        pmock = self.mox.CreateMockAnything()
+        pmock.stdin = self.mox.CreateMockAnything()
+        pmock.stdout = self.mox.CreateMockAnything()
+        pmock.pid = -1
+        subprocess.Popen(['relaytest'],
+                         stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE).AndReturn(pmock)
+        self._expect_frame(pmock, b'rcpt1@example.com', b'0\n')
+        self._expect_frame(pmock, b'rcpt2@example.com', b'67 5.1.1 Unknown\n')
+        result = self.mox.CreateMockAnything()
+        result.set({'rcpt1@example.com': None,
+                    'rcpt2@example.com': IsA(PermanentRelayError)})
+        self.mox.ReplayAll()
+        self.client._deliver(result, self.env)
+
+    def test_deliver_worker_exited(self):
+        self.client.process = pmock = self.mox.CreateMockAnything()
+        pmock.stdin = self.mox.CreateMockAnything()
+        pmock.stdout = self.mox.CreateMockAnything()
+        pmock.pid = -1
+        pmock.returncode = 1
+        self._expect_frame(pmock, b'rcpt1@example.com', b'')
+        pmock.stdin.close()
+        pmock.wait(10.0)
+        self.mox.ReplayAll()
+        exc = self.client._deliver_rcpt(self.env, 'rcpt1@example.com',
+                                        b'From: sender@example.com\r\n\r\n',
+                                        b'test test\r\n')
+        self.assertIsInstance(exc, TransientRelayError)
+        self.assertIsNone(self.client.process)
+
+    def test_stop_process_timeout(self):
+        self.client.process = pmock = self.mox.CreateMockAnything()
+        pmock.stdin = self.mox.CreateMockAnything()
+        pmock.pid = -1
+        pmock.returncode = -9
+        pmock.stdin.close()
+        pmock.wait(10.0).AndRaise(subprocess.TimeoutExpired(['relaytest'], 10.0))
+        pmock.kill()
+        pmock.wait()
+        self.mox.ReplayAll()
+        self.client._stop_process()
+        self.assertIsNone(self.client.process)
+
+    def test_deliver_timeout(self):
+        self.mox.StubOutWithMock(self.client, '_deliver_rcpt')
+        self.client._deliver_rcpt(self.env, 'rcpt1@example.com', IsA(bytes), IsA(bytes)).AndRaise(Timeout)
+        self.mox.ReplayAll()
+        result = AsyncResult()
+        self.client._deliver(result, self.env)
+        results = result.get_nowait()
+        self.assertIsInstance(results['rcpt1@example.com'], TransientRelayError)
+        self.assertEqual('450', results['rcpt1@example.com'].reply.code)
+        self.assertIs(results['rcpt1@example.com'], results['rcpt2@example.com'])
+
+    def test_run_default_idle_timeout(self):
+        client = PipeWorkerClient(PersistentPipeRelay(['relaytest']))
+        self.mox.StubOutWithMock(client, 'poll')
+        self.mox.StubOutWithMock(client, '_deliver')
+        client.poll().AndReturn((1, 2))
+        client._deliver(1, 2)
+        client.poll().AndReturn((3, 4))
+        client._deliver(3, 4)
+        client.poll().AndReturn((None, None))
+        self.mox.ReplayAll()
+        client._run()
+
+    def test_run(self):
+        self.mox.StubOutWithMock(self.client, 'poll')
+        self.mox.StubOutWithMock(self.client, '_deliver')
+        self.client.poll().AndReturn((1, 2))
+        self.client._deliver(1, 2)
+        self.client.poll().AndReturn((None, None))
+        self.mox.ReplayAll()
+        self.client._run()
+
 
 class TestMaildropRelay(MoxTestBase, unittest.TestCase):
 
     def test_attempt(self):
         self.mox.StubOutWithMock(subprocess, 'Popen')
+        self.mox.StubOutWithMock(pipe, '_writev_all')
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
-        pmock = self.mox.CreateMockAnything()
+        pmock = _mock_process(self.mox, 0, '')
         subprocess.Popen(['maildrop', '-f', 'sender@example.com'],
                          stdin=subprocess.PIPE,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE).AndReturn(pmock)
-        pmock.communicate(b'From: sender@example.com\r\n\r\ntest test\r\n').AndReturn(('', ''))
-        pmock.pid = -1
-        pmock.returncode = 0
         self.mox.ReplayAll()
         m = MaildropRelay()
+        m._posix_spawn = False
         result = m.attempt(env, 0)
         self.assertEqual(None, result)
 
@@ -81,6 +359,7 @@ class TestMaildropRelay(MoxTestBase, unittest.TestCase):
                          stderr=subprocess.PIPE).AndRaise(Timeout)
         self.mox.ReplayAll()
         m = MaildropRelay()
+        m._posix_spawn = False
         with self.assertRaises(TransientRelayError):
             m.attempt(env, 0)
 
@@ -90,10 +369,15 @@ class TestMaildropRelay(MoxTestBase, unittest.TestCase):
 
     def test_raise_error(self):
         m = MaildropRelay()
-        with self.assertRaises(TransientRelayError):
-            m.raise_error(m.EX_TEMPFAIL, 'message', '')
-        with self.assertRaises(PermanentRelayError):
-            m.raise_error(13, 'message', '')
+        with self.assertRaises(TransientRelayError) as cm:
+            m.raise_error(m.EX_TEMPFAIL, b'message', b'')
+        self.assertEqual('Delivery failed', str(cm.exception))
+        with self.assertRaises(PermanentRelayError) as cm:
+            m.raise_error(13, b'maildrop: stdout message\n', b'')
+        self.assertEqual('stdout message', str(cm.exception))
+        with self.assertRaises(TransientRelayError) as cm:
+            m.raise_error(m.EX_TEMPFAIL, b'', b'maildrop: stderr message\n')
+        self.assertEqual('stderr message', str(cm.exception))
 
 
 class TestDovecotLdaRelay(MoxTestBase, unittest.TestCase):
@@ -104,10 +388,12 @@ class TestDovecotLdaRelay(MoxTestBase, unittest.TestCase):
 
     def test_raise_error(self):
         m = DovecotLdaRelay()
-        with self.assertRaises(TransientRelayError):
-            m.raise_error(m.EX_TEMPFAIL, 'message', '')
-        with self.assertRaises(PermanentRelayError):
-            m.raise_error(13, 'message', '')
+        with self.assertRaises(TransientRelayError) as cm:
+            m.raise_error(m.EX_TEMPFAIL, b'message\n', b'')
+        self.assertEqual('message', str(cm.exception))
+        with self.assertRaises(PermanentRelayError) as cm:
+            m.raise_error(13, b'', b'')
+        self.assertEqual('LDA delivery failed', str(cm.exception))
 
 
 # vim:et:fdm=marker:sts=4:sw=4:ts=4
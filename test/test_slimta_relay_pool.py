@@ -54,6 +54,21 @@ class TestRelayPool(unittest.TestCase):
         ret = pool.attempt(env, 0)
         self.assertEqual('test', ret)
 
+    def test_check_idle(self):
+        pool = FakePool(2)
+        pool._check_idle()
+        self.assertEqual(1, len(pool.pool))
+        gevent.sleep(0)
+        self.assertEqual(1, pool.queue.waiting)
+        pool._check_idle()
+        self.assertEqual(1, len(pool.pool))
+        pool.queue.append(None)
+        pool._check_idle()
+        self.assertEqual(2, len(pool.pool))
+        pool._check_idle()
+        self.assertEqual(2, len(pool.pool))
+        gevent.killall(list(pool.pool))
+
     def test_kill(self):
         pool = RelayPool()
         pool.pool.add(RelayPoolClient(None))
@@ -1,17 +1,20 @@
 from email.encoders import encode_base64
 
 import unittest
+import gevent
 from mox import MoxTestBase, IsA
 from gevent import Timeout
-from gevent.socket import socket, error as socket_error
+from gevent.socket import socket, error as socket_error, \
+    IPPROTO_TCP, TCP_NODELAY
 from gevent.ssl import SSLContext
 from gevent.event import AsyncResult
 
-from slimta.util.deque import BlockingDeque
+from slimta.util.ring import GeventRing
 from slimta.smtp import ConnectionLost, SmtpError
 from slimta.smtp.reply import Reply
 from slimta.relay import TransientRelayError, PermanentRelayError
-from slimta.relay.smtp.client import SmtpRelayClient
+from slimta.relay.smtp import client as smtp_client
+from slimta.relay.smtp.client import SmtpRelayClient, _CommandTimeout
 from slimta.envelope import Envelope
 
 
@@ -22,7 +25,7 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         self.sock = self.mox.CreateMock(socket)
         self.sock.fileno = lambda: -1
         self.sock.getpeername = lambda: ('test', 0)
-        self.queue = self.mox.CreateMock(BlockingDeque)
+        self.queue = self.mox.CreateMock(GeventRing)
         self.context = self.mox.CreateMock(SSLContext)
         self.context.session_stats = lambda: {}
 
@@ -34,6 +37,34 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         client = SmtpRelayClient(('addr', 0), self.queue, socket_creator=self._socket_creator)
         client._connect()
 
+    def test_connect_nodelay(self):
+        self.mox.StubOutWithMock(smtp_client, 'create_connection')
+        smtp_client.create_connection(('addr', 0)).AndReturn(self.sock)
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.mox.ReplayAll()
+        client = SmtpRelayClient(('addr', 0), self.queue)
+        client._connect()
+
+    def test_command_timeout_reuse(self):
+        timer = _CommandTimeout(0.01)
+        with timer:
+            pass
+        with self.assertRaises(Timeout):
+            with timer:
+                gevent.sleep(0.1)
+        with timer:
+            pass
+
+    def test_default_ehlo_as(self):
+        self.mox.StubOutWithMock(smtp_client, 'get_hostname')
+        smtp_client.get_hostname().AndReturn('fqdn.example.com')
+        smtp_client.get_hostname().AndReturn('fqdn.example.com')
+        self.mox.ReplayAll()
+        client1 = SmtpRelayClient(('addr', 0), self.queue)
+        client2 = SmtpRelayClient(('addr', 0), self.queue)
+        self.assertEqual('fqdn.example.com', client1.ehlo_as)
+        self.assertEqual('fqdn.example.com', client2.ehlo_as)
+
     def test_banner(self):
         self.sock.recv(IsA(int)).AndReturn(b'220 Welcome\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'420 Not Welcome\r\n')
@@ -56,6 +87,14 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         with self.assertRaises(TransientRelayError):
             client._ehlo()
 
+    def test_ehlo_callable(self):
+        self.sock.sendall(b'EHLO addr.there\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 TEST\r\n')
+        self.mox.ReplayAll()
+        client = SmtpRelayClient(('addr', 0), self.queue, socket_creator=self._socket_creator, ehlo_as=lambda address: address[0] + '.there')
+        client._connect()
+        client._ehlo()
+
     def test_starttls(self):
         self.sock.sendall(b'STARTTLS\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'220 Go ahead\r\n')
@@ -221,8 +260,6 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Ok\r\n354 Go ahead\r\n')
         self.sock.sendall(b'From: sender@example.com\r\n\r\ntest test\r\n.\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'450 Yikes\r\n')
-        self.sock.sendall(b'RSET\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
         self.mox.ReplayAll()
         client = SmtpRelayClient(('addr', 0), self.queue, socket_creator=self._socket_creator, ehlo_as='there')
         client._connect()
@@ -254,9 +291,13 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
         self.sock.sendall(b'EHLO there\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
-        self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Ok\r\n450 No!\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Hello\r\n')
+        self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
+        self.sock.sendall(b'RCPT TO:<rcpt@example.com>\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
+        self.sock.sendall(b'DATA\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'450 No!\r\n')
         self.sock.sendall(b'RSET\r\n')
         self.sock.recv(IsA(int)).AndRaise(ConnectionLost)
         self.mox.ReplayAll()
@@ -268,6 +309,29 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         with self.assertRaises(TransientRelayError):
             result.get_nowait()
 
+    def test_deliver_rset_pipelined(self):
+        result1 = AsyncResult()
+        result2 = AsyncResult()
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
+        self.sock.sendall(b'EHLO there\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
+        self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Ok\r\n450 No!\r\n')
+        self.sock.sendall(b'RSET\r\nMAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Ok\r\n250 Ok\r\n354 Go ahead\r\n')
+        self.sock.sendall(b'From: sender@example.com\r\n\r\ntest test\r\n.\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
+        self.mox.ReplayAll()
+        client = SmtpRelayClient(('addr', 0), self.queue, socket_creator=self._socket_creator, ehlo_as='there')
+        client._connect()
+        client._ehlo()
+        client._deliver(result1, env)
+        with self.assertRaises(TransientRelayError):
+            result1.get_nowait()
+        client._deliver(result2, env)
+        self.assertEqual({'rcpt@example.com': Reply('250', 'Ok')}, result2.get_nowait())
+
     def test_deliver_conversion(self):
         result = AsyncResult()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
@@ -291,8 +355,6 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         env.parse(b'From: sender@example.com\r\n\r\ntest test \x81\r\n')
         self.sock.sendall(b'EHLO there\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
-        self.sock.sendall(b'RSET\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
         self.mox.ReplayAll()
         client = SmtpRelayClient(('addr', 0), self.queue, socket_creator=self._socket_creator, ehlo_as='there')
         client._connect()
@@ -310,6 +372,14 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         client._connect()
         client._disconnect()
 
+    def test_disconnect_broken(self):
+        self.sock.close()
+        self.mox.ReplayAll()
+        client = SmtpRelayClient(('addr', 0), self.queue, socket_creator=self._socket_creator)
+        client._connect()
+        client.client.io.send_command(b'NOOP')
+        client._disconnect(graceful=False)
+
     def test_disconnect_failure(self):
         self.sock.sendall(b'QUIT\r\n')
         self.sock.recv(IsA(int)).AndRaise(socket_error(None, None))
@@ -323,7 +393,7 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         result = AsyncResult()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
-        queue = BlockingDeque()
+        queue = GeventRing()
         queue.append((result, env))
         self.sock.recv(IsA(int)).AndReturn(b'220 Welcome\r\n')
         self.sock.sendall(b'EHLO there\r\n')
@@ -347,7 +417,7 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         env1.parse(b'From: sender1@example.com\r\n\r\ntest test\r\n')
         env2 = Envelope('sender2@example.com', ['rcpt2@example.com'])
         env2.parse(b'From: sender2@example.com\r\n\r\ntest test\r\n')
-        queue = BlockingDeque()
+        queue = GeventRing()
         queue.append((result1, env1))
         queue.append((result2, env2))
         self.sock.recv(IsA(int)).AndReturn(b'220 Welcome\r\n')
@@ -370,11 +440,41 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         self.assertEqual({'rcpt1@example.com': Reply('250', 'Ok')}, result1.get_nowait())
         self.assertEqual({'rcpt2@example.com': Reply('250', 'Ok')}, result2.get_nowait())
 
+    def test_run_badrcpts_pipelined_idle(self):
+        result = AsyncResult()
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
+        queue = GeventRing()
+        queue.append((result, env))
+        self.sock.recv(IsA(int)).AndReturn(b'220 Welcome\r\n')
+        self.sock.sendall(b'EHLO there\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
+        self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n550 Not ok\r\n354 Go ahead\r\n')
+        self.sock.sendall(b'.\r\nRSET\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'550 Yikes\r\n250 Ok\r\n')
+        self.mox.ReplayAll()
+        client = SmtpRelayClient(('addr', 0), queue, socket_creator=self._socket_creator, ehlo_as='there', idle_timeout=10.0)
+        job = gevent.spawn(client._run)
+        gevent.sleep(0.01)
+        self.assertEqual(1, queue.waiting)
+        self.mox.VerifyAll()
+        with self.assertRaises(PermanentRelayError):
+            result.get_nowait()
+        self.mox.ResetAll()
+        self.sock.sendall(b'QUIT\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'221 Goodbye\r\n')
+        self.sock.close()
+        self.mox.ReplayAll()
+        queue.append((None, None))
+        job.join(1.0)
+        self.assertTrue(job.successful())
+
     def test_run_random_exception(self):
         result = AsyncResult()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
-        queue = BlockingDeque()
+        queue = GeventRing()
         queue.append((result, env))
         self.sock.recv(IsA(int)).AndRaise(ValueError('test error'))
         self.sock.sendall(b'QUIT\r\n')
@@ -391,11 +491,9 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         result = AsyncResult()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
-        queue = BlockingDeque()
+        queue = GeventRing()
         queue.append((result, env))
         self.sock.recv(IsA(int)).AndRaise(socket_error(None, None))
-        self.sock.sendall(b'QUIT\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'221 Goodbye\r\n')
         self.sock.close()
         self.mox.ReplayAll()
         client = SmtpRelayClient(('addr', 0), queue, socket_creator=self._socket_creator, ehlo_as='there')
@@ -407,11 +505,9 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         result = AsyncResult()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
-        queue = BlockingDeque()
+        queue = GeventRing()
         queue.append((result, env))
         self.sock.recv(IsA(int)).AndRaise(SmtpError('test error'))
-        self.sock.sendall(b'QUIT\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'221 Goodbye\r\n')
         self.sock.close()
         self.mox.ReplayAll()
         client = SmtpRelayClient(('addr', 0), queue, socket_creator=self._socket_creator, ehlo_as='there')
@@ -423,11 +519,9 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         result = AsyncResult()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
-        queue = BlockingDeque()
+        queue = GeventRing()
         queue.append((result, env))
         self.sock.recv(IsA(int)).AndRaise(Timeout(0.0))
-        self.sock.sendall(b'QUIT\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'221 Goodbye\r\n')
         self.sock.close()
         self.mox.ReplayAll()
         client = SmtpRelayClient(('addr', 0), queue, socket_creator=self._socket_creator, ehlo_as='there')
@@ -439,7 +533,7 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
         result = AsyncResult()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
-        queue = BlockingDeque()
+        queue = GeventRing()
         queue.append((result, env))
         self.sock.recv(IsA(int)).AndReturn(b'520 Not Welcome\r\n')
         self.sock.sendall(b'QUIT\r\n')
@@ -452,7 +546,7 @@ class TestSmtpRelayClient(MoxTestBase, unittest.TestCase):
             result.get_nowait()
 
     def test_run_nomessages(self):
-        queue = BlockingDeque()
+        queue = GeventRing()
         self.mox.ReplayAll()
         client = SmtpRelayClient(('addr', 0), queue, idle_timeout=0)
         client._run()
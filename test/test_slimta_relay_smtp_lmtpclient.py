@@ -5,7 +5,7 @@ from mox import MoxTestBase, IsA
 from gevent.socket import socket, error as socket_error
 from gevent.event import AsyncResult
 
-from slimta.util.deque import BlockingDeque
+from slimta.util.ring import GeventRing
 from slimta.smtp import ConnectionLost
 from slimta.relay import TransientRelayError, PermanentRelayError
 from slimta.relay.smtp.lmtpclient import LmtpRelayClient
@@ -20,7 +20,7 @@ class TestLmtpRelayClient(MoxTestBase, unittest.TestCase):
         self.sock = self.mox.CreateMock(socket)
         self.sock.fileno = lambda: -1
         self.sock.getpeername = lambda: ('test', 0)
-        self.queue = self.mox.CreateMock(BlockingDeque)
+        self.queue = self.mox.CreateMock(GeventRing)
         self.tls_args = {'test': 'test'}
 
     def _socket_creator(self, address):
@@ -67,9 +67,9 @@ class TestLmtpRelayClient(MoxTestBase, unittest.TestCase):
         self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
         self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'550 Not ok\r\n250 Ok\r\n354 Go ahead\r\n')
-        result.set_exception(IsA(PermanentRelayError))
         self.sock.sendall(b'.\r\nRSET\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'550 Yikes\r\n250 Ok\r\n')
+        result.set_exception(IsA(PermanentRelayError))
         self.mox.ReplayAll()
         client = LmtpRelayClient('addr', self.queue, socket_creator=self._socket_creator, ehlo_as='there')
         client._connect()
@@ -89,8 +89,6 @@ class TestLmtpRelayClient(MoxTestBase, unittest.TestCase):
         result.set({'rcpt1@example.com': Reply('250', 'Ok'),
                     'rcpt2@example.com': IsA(PermanentRelayError),
                     'rcpt3@example.com': IsA(TransientRelayError)})
-        self.sock.sendall(b'RSET\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
         self.mox.ReplayAll()
         client = LmtpRelayClient('addr', self.queue, socket_creator=self._socket_creator, ehlo_as='there')
         client._connect()
@@ -106,7 +104,7 @@ class TestLmtpRelayClient(MoxTestBase, unittest.TestCase):
         self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n550 Not ok\r\n354 Go ahead\r\n')
         self.sock.sendall(b'.\r\nRSET\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'550 Yikes\r\n250 Ok\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
         result.set_exception(IsA(PermanentRelayError))
         self.mox.ReplayAll()
         client = LmtpRelayClient('addr', self.queue, socket_creator=self._socket_creator, ehlo_as='there')
@@ -119,9 +117,13 @@ class TestLmtpRelayClient(MoxTestBase, unittest.TestCase):
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
         self.sock.sendall(b'LHLO there\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
-        self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Ok\r\n450 No!\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Hello\r\n')
+        self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
+        self.sock.sendall(b'RCPT TO:<rcpt@example.com>\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
+        self.sock.sendall(b'DATA\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'450 No!\r\n')
         result.set_exception(IsA(TransientRelayError))
         self.sock.sendall(b'RSET\r\n')
         self.sock.recv(IsA(int)).AndRaise(ConnectionLost)
@@ -132,6 +134,28 @@ class TestLmtpRelayClient(MoxTestBase, unittest.TestCase):
         with self.assertRaises(ConnectionLost):
             client._deliver(result, env)
 
+    def test_deliver_rset_pipelined(self):
+        result1 = self.mox.CreateMockAnything()
+        result2 = self.mox.CreateMockAnything()
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        env.parse(b'From: sender@example.com\r\n\r\ntest test\r\n')
+        self.sock.sendall(b'LHLO there\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
+        self.sock.sendall(b'MAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Ok\r\n450 No!\r\n')
+        result1.set_exception(IsA(TransientRelayError))
+        self.sock.sendall(b'RSET\r\nMAIL FROM:<sender@example.com>\r\nRCPT TO:<rcpt@example.com>\r\nDATA\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Ok\r\n250 Ok\r\n354 Go ahead\r\n')
+        self.sock.sendall(b'From: sender@example.com\r\n\r\ntest test\r\n.\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
+        result2.set({'rcpt@example.com': Reply('250', 'Ok')})
+        self.mox.ReplayAll()
+        client = LmtpRelayClient('addr', self.queue, socket_creator=self._socket_creator, ehlo_as='there')
+        client._connect()
+        client._ehlo()
+        client._deliver(result1, env)
+        client._deliver(result2, env)
+
     def test_deliver_conversion(self):
         result = self.mox.CreateMockAnything()
         env = Envelope('sender@example.com', ['rcpt@example.com'])
@@ -155,8 +179,6 @@ class TestLmtpRelayClient(MoxTestBase, unittest.TestCase):
         env.parse(b'From: sender@example.com\r\n\r\ntest test \x81\r\n')
         self.sock.sendall(b'LHLO there\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'250-Hello\r\n250 PIPELINING\r\n')
-        self.sock.sendall(b'RSET\r\n')
-        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n')
         result.set_exception(IsA(PermanentRelayError))
         self.mox.ReplayAll()
         client = LmtpRelayClient('addr', self.queue, socket_creator=self._socket_creator, ehlo_as='there')
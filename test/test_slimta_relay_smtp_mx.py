@@ -1,9 +1,11 @@
 import unittest
+import gevent
 from mox import MoxTestBase
 from pycares.errno import ARES_ENOTFOUND, ARES_ENODATA
 
 from slimta.relay import PermanentRelayError
-from slimta.relay.smtp.mx import MxSmtpRelay, NoDomainError
+from slimta.relay.smtp.mx import MxSmtpRelay, NoDomainError, _LruCache, \
+    _RelayerCache
 from slimta.relay.smtp.static import StaticSmtpRelay
 from slimta.util.dns import DNSResolver, DNSError
 from slimta.envelope import Envelope
@@ -18,6 +20,22 @@ class FakeAsyncResult(object):
         return self.answer
 
 
+class FailedAsyncResult(object):
+
+    def __init__(self, errno):
+        self.errno = errno
+
+    def get(self):
+        raise DNSError(self.errno)
+
+
+class SlowAsyncResult(FakeAsyncResult):
+
+    def get(self):
+        gevent.sleep(0.01)
+        return self.answer
+
+
 class FakeMxAnswer(object):
 
     def __init__(self, expired, rdata):
@@ -45,6 +63,38 @@ class FakeAAnswer(object):
         return iter(self.rdata)
 
 
+class TestLruCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = _LruCache(2)
+        cache['one'] = 1
+        cache['two'] = 2
+        self.assertEqual(1, cache['one'])
+        cache['three'] = 3
+        self.assertEqual(['one', 'three'], list(cache))
+        self.assertEqual(1, cache.get('one'))
+        self.assertEqual(4, cache.setdefault('four', 4))
+        self.assertEqual(['one', 'four'], list(cache))
+        self.assertIsNone(cache.get('two'))
+
+    def test_unbounded(self):
+        cache = _LruCache()
+        for i in range(10):
+            cache[i] = i
+        self.assertEqual(10, len(cache))
+
+    def test_relayer_eviction(self):
+        idle = StaticSmtpRelay('idle.example.com')
+        busy = StaticSmtpRelay('busy.example.com')
+        busy.pool.add(object())
+        cache = _RelayerCache(1)
+        cache['busy'] = busy
+        cache['idle'] = idle
+        self.assertEqual(['busy', 'idle'], list(cache))
+        cache['new'] = StaticSmtpRelay('new.example.com')
+        self.assertEqual(['busy', 'new'], list(cache))
+
+
 class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
 
     def test_get_rcpt_domain(self):
@@ -56,6 +106,8 @@ class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
         env = Envelope('sender@example.com', ['badrcpt'])
         mx = MxSmtpRelay()
         self.assertRaises(NoDomainError, mx._get_rcpt_domain, env)
+        env = Envelope('sender@example.com', ['badrcpt@'])
+        self.assertRaises(NoDomainError, mx._get_rcpt_domain, env)
 
     def test_choose_mx(self):
         records = [(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)]
@@ -75,6 +127,7 @@ class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
         self.mox.StubOutWithMock(mx, 'new_static_relay')
         self.mox.StubOutWithMock(DNSResolver, 'query')
         DNSResolver.query('example.com', 'MX').AndReturn(FakeAsyncResult(mx_ret))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
         mx.new_static_relay('mx1.example.com', 25).AndReturn(static)
         static.attempt(env, 0)
         mx.new_static_relay('mx2.example.com', 25).AndReturn(static)
@@ -83,6 +136,41 @@ class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
         mx.attempt(env, 0)
         mx.attempt(env, 1)
 
+    def test_attempt_concurrent(self):
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        mx_ret = FakeMxAnswer(False, [(5, 'mx1.example.com')])
+        mx = MxSmtpRelay()
+        static = self.mox.CreateMock(StaticSmtpRelay)
+        self.mox.StubOutWithMock(mx, 'new_static_relay')
+        self.mox.StubOutWithMock(DNSResolver, 'query')
+        DNSResolver.query('example.com', 'MX').AndReturn(SlowAsyncResult(mx_ret))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
+        mx.new_static_relay('mx1.example.com', 25).AndReturn(static)
+        static.attempt(env, 0)
+        static.attempt(env, 0)
+        self.mox.ReplayAll()
+        jobs = [gevent.spawn(mx.attempt, env, 0) for _ in range(2)]
+        gevent.joinall(jobs, raise_error=True)
+
+    def test_prefetch(self):
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        mx_ret = FakeMxAnswer(False, [(5, 'mx1.example.com')])
+        mx = MxSmtpRelay()
+        static = self.mox.CreateMock(StaticSmtpRelay)
+        self.mox.StubOutWithMock(mx, 'new_static_relay')
+        self.mox.StubOutWithMock(DNSResolver, 'query')
+        DNSResolver.query('example.com', 'MX').AndReturn(FakeAsyncResult(mx_ret))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
+        DNSResolver.query('bad.example.com', 'MX').AndReturn(FailedAsyncResult(ARES_ENOTFOUND))
+        DNSResolver.query('bad.example.com', 'A').AndReturn(FailedAsyncResult(ARES_ENOTFOUND))
+        mx.new_static_relay('mx1.example.com', 25).AndReturn(static)
+        static.attempt(env, 0)
+        self.mox.ReplayAll()
+        mx.force_mx('forced.example.com', 'mail.example.com')
+        mx.prefetch(['Example.com', 'example.com', 'bad.example.com',
+                     'forced.example.com'])
+        mx.attempt(env, 0)
+
     def test_attempt_no_mx(self):
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         a_ret = FakeAAnswer(False, [('1.2.3.4', )])
@@ -90,7 +178,7 @@ class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
         static = self.mox.CreateMock(StaticSmtpRelay)
         self.mox.StubOutWithMock(mx, 'new_static_relay')
         self.mox.StubOutWithMock(DNSResolver, 'query')
-        DNSResolver.query('example.com', 'MX').AndRaise(DNSError(ARES_ENOTFOUND))
+        DNSResolver.query('example.com', 'MX').AndReturn(FailedAsyncResult(ARES_ENOTFOUND))
         DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult(a_ret))
         mx.new_static_relay('example.com', 25).AndReturn(static)
         static.attempt(env, 0)
@@ -102,12 +190,25 @@ class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
         mx = MxSmtpRelay()
         self.mox.StubOutWithMock(mx, 'new_static_relay')
         self.mox.StubOutWithMock(DNSResolver, 'query')
-        DNSResolver.query('example.com', 'MX').AndRaise(DNSError(ARES_ENOTFOUND))
-        DNSResolver.query('example.com', 'A').AndRaise(DNSError(ARES_ENOTFOUND))
+        DNSResolver.query('example.com', 'MX').AndReturn(FailedAsyncResult(ARES_ENOTFOUND))
+        DNSResolver.query('example.com', 'A').AndReturn(FailedAsyncResult(ARES_ENOTFOUND))
         self.mox.ReplayAll()
         with self.assertRaises(PermanentRelayError):
             mx.attempt(env, 0)
 
+    def test_attempt_no_records_cached(self):
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        mx = MxSmtpRelay()
+        self.mox.StubOutWithMock(mx, 'new_static_relay')
+        self.mox.StubOutWithMock(DNSResolver, 'query')
+        DNSResolver.query('example.com', 'MX').AndReturn(FailedAsyncResult(ARES_ENOTFOUND))
+        DNSResolver.query('example.com', 'A').AndReturn(FailedAsyncResult(ARES_ENOTFOUND))
+        self.mox.ReplayAll()
+        with self.assertRaises(PermanentRelayError):
+            mx.attempt(env, 0)
+        with self.assertRaises(PermanentRelayError):
+            mx.attempt(env, 1)
+
     def test_attempt_expiredmx(self):
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         mx_ret = FakeMxAnswer(True, [(10, 'mx2.example.com'),
@@ -117,15 +218,57 @@ class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
         self.mox.StubOutWithMock(mx, 'new_static_relay')
         self.mox.StubOutWithMock(DNSResolver, 'query')
         DNSResolver.query('example.com', 'MX').AndReturn(FakeAsyncResult(mx_ret))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
         mx.new_static_relay('mx1.example.com', 25).AndReturn(static)
         static.attempt(env, 0)
         DNSResolver.query('example.com', 'MX').AndReturn(FakeAsyncResult(mx_ret))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
         mx.new_static_relay('mx2.example.com', 25).AndReturn(static)
         static.attempt(env, 1)
         self.mox.ReplayAll()
         mx.attempt(env, 0)
         mx.attempt(env, 1)
 
+    def test_attempt_min_ttl(self):
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        mx_ret = FakeMxAnswer(True, [(5, 'mx1.example.com')])
+        mx = MxSmtpRelay(min_ttl=60.0)
+        static = self.mox.CreateMock(StaticSmtpRelay)
+        self.mox.StubOutWithMock(mx, 'new_static_relay')
+        self.mox.StubOutWithMock(DNSResolver, 'query')
+        DNSResolver.query('example.com', 'MX').AndReturn(FakeAsyncResult(mx_ret))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
+        mx.new_static_relay('mx1.example.com', 25).AndReturn(static)
+        static.attempt(env, 0)
+        static.attempt(env, 1)
+        self.mox.ReplayAll()
+        mx.attempt(env, 0)
+        mx.attempt(env, 1)
+
+    def test_attempt_refresh_ahead(self):
+        env = Envelope('sender@example.com', ['rcpt@example.com'])
+        mx_ret1 = FakeMxAnswer(False, [(5, 'mx1.example.com')])
+        mx_ret2 = FakeMxAnswer(False, [(5, 'mx2.example.com')])
+        mx = MxSmtpRelay()
+        static = self.mox.CreateMock(StaticSmtpRelay)
+        self.mox.StubOutWithMock(mx, 'new_static_relay')
+        self.mox.StubOutWithMock(DNSResolver, 'query')
+        DNSResolver.query('example.com', 'MX').AndReturn(FakeAsyncResult(mx_ret1))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
+        mx.new_static_relay('mx1.example.com', 25).AndReturn(static)
+        static.attempt(env, 0)
+        static.attempt(env, 0)
+        DNSResolver.query('example.com', 'MX').AndReturn(FakeAsyncResult(mx_ret2))
+        DNSResolver.query('example.com', 'A').AndReturn(FakeAsyncResult())
+        mx.new_static_relay('mx2.example.com', 25).AndReturn(static)
+        static.attempt(env, 0)
+        self.mox.ReplayAll()
+        mx.attempt(env, 0)
+        mx._mx_records['example.com']._refresh_at = 0
+        mx.attempt(env, 0)
+        gevent.sleep(0)
+        mx.attempt(env, 0)
+
     def test_attempt_force_mx(self):
         env = Envelope('sender@example.com', ['rcpt@example.com'])
         mx = MxSmtpRelay()
@@ -144,8 +287,8 @@ class TestMxSmtpRelay(MoxTestBase, unittest.TestCase):
         mx = MxSmtpRelay()
         self.mox.StubOutWithMock(mx, 'new_static_relay')
         self.mox.StubOutWithMock(DNSResolver, 'query')
-        DNSResolver.query('example.com', 'MX').AndRaise(DNSError(ARES_ENODATA))
-        DNSResolver.query('example.com', 'A').AndRaise(DNSError(ARES_ENODATA))
+        DNSResolver.query('example.com', 'MX').AndReturn(FailedAsyncResult(ARES_ENODATA))
+        DNSResolver.query('example.com', 'A').AndReturn(FailedAsyncResult(ARES_ENODATA))
         self.mox.ReplayAll()
         with self.assertRaises(PermanentRelayError):
             mx.attempt(env, 0)
@@ -8,7 +8,7 @@ from pysasl.identity import ClearIdentity
 
 from slimta.smtp.io import IO
 from slimta.smtp.auth import AuthSession, \
-    InvalidMechanismError, AuthenticationCanceled
+    InvalidMechanismError, AuthenticationCanceled, InvalidAuthString
 
 
 class TestSmtpAuth(MoxTestBase, unittest.TestCase):
@@ -25,6 +25,16 @@ class TestSmtpAuth(MoxTestBase, unittest.TestCase):
         auth = AuthSession(SASLAuth.defaults(), self.io)
         self.assertEqual('PLAIN LOGIN', str(auth))
 
+    def test_parse_arg(self):
+        auth = AuthSession(SASLAuth.defaults(), self.io)
+        self.assertEqual((b'PLAIN', None), auth._parse_arg(b'plain'))
+        self.assertEqual((b'PLAIN', b'dGVzdA=='),
+                         auth._parse_arg(b'plain  dGVzdA=='))
+        with self.assertRaises(InvalidMechanismError):
+            auth._parse_arg(b'')
+        with self.assertRaises(InvalidMechanismError):
+            auth._parse_arg(b'B@D arg')
+
     def test_invalid_mechanism(self):
         auth = AuthSession(SASLAuth.defaults(), self.io)
         with self.assertRaises(InvalidMechanismError):
@@ -50,6 +60,12 @@ class TestSmtpAuth(MoxTestBase, unittest.TestCase):
         self.assertEqual(u'testzid', result.authzid)
         self.assertTrue(result.verify(ClearIdentity(u'testuser', u'testpassword')))
 
+    def test_plain_invalid(self):
+        self.mox.ReplayAll()
+        auth = AuthSession(SASLAuth.defaults(), self.io)
+        with self.assertRaises(InvalidAuthString):
+            auth.server_attempt(b'PLAIN dGVzdA')
+
     def test_plain_canceled(self):
         self.sock.sendall(b'334 \r\n')
         self.sock.recv(IsA(int)).AndReturn(b'*\r\n')
@@ -225,6 +225,19 @@ class TestSmtpClient(MoxTestBase, unittest.TestCase):
         self.assertEqual('2.0.0 Ok', reply.message)
         self.assertEqual(b'RSET', reply.command)
 
+    def test_rset_pipelined(self):
+        self.sock.sendall(b'RSET\r\nMAIL FROM:<test>\r\n')
+        self.sock.recv(IsA(int)).AndReturn(b'250 Ok\r\n250 Sender Ok\r\n')
+        self.mox.ReplayAll()
+        client = Client(self.sock)
+        client.extensions.add('PIPELINING')
+        reply = client.rset(pipeline=True)
+        self.assertEqual(None, reply.code)
+        client.mailfrom('test')
+        client._flush_pipeline()
+        self.assertEqual('250', reply.code)
+        self.assertEqual(b'RSET', reply.command)
+
     def test_quit(self):
         self.sock.sendall(b'QUIT\r\n')
         self.sock.recv(IsA(int)).AndReturn(b'221 Bye\r\n')
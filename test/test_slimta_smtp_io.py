@@ -40,6 +40,30 @@ class TestSmtpIO(MoxTestBase, unittest.TestCase):
         io.buffered_send(b'some data')
         io.flush_send()
 
+    def test_buffered_send_segment(self):
+        big = b'x' * 8192
+        self.mox.ReplayAll()
+        io = IO(self.sock)
+        io.buffered_send(b'one')
+        io.buffered_send(big)
+        io.buffered_send(b'two')
+        self.assertEqual([b'one', big], io.send_segments)
+        self.assertEqual(b'two', io.send_buffer.getvalue())
+
+    def test_flush_send_segments(self):
+        big = b'x' * 8192
+        self.sock.sendmsg([b'one', big, b'two']).AndReturn(5)
+        self.sock.sendmsg([big[2:], b'two']).AndReturn(8190)
+        self.sock.sendmsg([b'two']).AndReturn(3)
+        self.mox.ReplayAll()
+        io = IO(self.sock)
+        io.buffered_send(b'one')
+        io.buffered_send(big)
+        io.buffered_send(b'two')
+        io.flush_send()
+        self.assertEqual([], io.send_segments)
+        self.assertEqual(b'', io.send_buffer.getvalue())
+
     def test_flush_send_empty(self):
         self.mox.ReplayAll()
         io = IO(self.sock)
@@ -0,0 +1,28 @@
+
+import unittest
+
+from mox import MoxTestBase
+from gevent import socket
+
+from slimta.util.hostname import get_hostname
+
+
+class TestHostname(MoxTestBase, unittest.TestCase):
+
+    def setUp(self):
+        super(TestHostname, self).setUp()
+        self.mox.StubOutWithMock(socket, 'getfqdn')
+        get_hostname.cache_clear()
+
+    def tearDown(self):
+        super(TestHostname, self).tearDown()
+        get_hostname.cache_clear()
+
+    def test_get_hostname(self):
+        socket.getfqdn().AndReturn('fqdn.example.com')
+        self.mox.ReplayAll()
+        self.assertEqual('fqdn.example.com', get_hostname())
+        self.assertEqual('fqdn.example.com', get_hostname())
+
+
+# vim:et:fdm=marker:sts=4:sw=4:ts=4
@@ -0,0 +1,89 @@
+import unittest
+
+import gevent
+from gevent import Timeout
+
+from slimta.util.ring import GeventRing
+
+
+class TestGeventRing(unittest.TestCase):
+
+    def test_size(self):
+        ring = GeventRing(5)
+        self.assertEqual(8, len(ring._items))
+        self.assertEqual(0, len(ring))
+
+    def test_append_popleft(self):
+        ring = GeventRing()
+        ring.append(1)
+        ring.append(2)
+        ring.append(3)
+        self.assertEqual(3, len(ring))
+        self.assertEqual(1, ring.popleft())
+        self.assertEqual(2, ring.popleft())
+        self.assertEqual(3, ring.popleft())
+        self.assertEqual(0, len(ring))
+
+    def test_appendleft(self):
+        ring = GeventRing()
+        ring.append(1)
+        ring.appendleft(2)
+        ring.appendleft(3)
+        self.assertEqual([3, 2, 1], list(ring))
+
+    def test_grow(self):
+        ring = GeventRing(2)
+        ring.append(1)
+        ring.appendleft(2)
+        ring.append(3)
+        ring.appendleft(4)
+        ring.append(5)
+        self.assertEqual(8, len(ring._items))
+        self.assertEqual([4, 2, 1, 3, 5], list(ring))
+        self.assertEqual(4, ring.popleft())
+        self.assertEqual(2, ring.popleft())
+
+    def test_popleft_blocks(self):
+        ring = GeventRing()
+        consumers = [gevent.spawn(ring.popleft) for i in range(3)]
+        gevent.sleep(0)
+        ring.append(1)
+        ring.append(2)
+        gevent.sleep(0)
+        ring.append(3)
+        gevent.joinall(consumers)
+        self.assertEqual([1, 2, 3], [c.value for c in consumers])
+
+    def test_handoff(self):
+        ring = GeventRing()
+        consumer = gevent.spawn(ring.popleft)
+        gevent.sleep(0)
+        self.assertEqual(1, ring.waiting)
+        ring.append(1)
+        self.assertEqual(0, ring.waiting)
+        self.assertEqual(0, len(ring))
+        ring.append(2)
+        self.assertEqual([2], list(ring))
+        consumer.join()
+        self.assertEqual(1, consumer.value)
+
+    def test_handoff_interrupted(self):
+        ring = GeventRing()
+        consumer = gevent.spawn(ring.popleft)
+        gevent.sleep(0)
+        consumer.kill(block=False)
+        ring.append(1)
+        consumer.join()
+        gevent.sleep(0)
+        self.assertEqual([1], list(ring))
+
+    def test_popleft_timeout(self):
+        ring = GeventRing()
+        with self.assertRaises(Timeout):
+            with Timeout(0.01):
+                ring.popleft()
+        ring.append(1)
+        self.assertEqual(1, ring.popleft())
+
+
+# vim:et:fdm=marker:sts=4:sw=4:ts=4